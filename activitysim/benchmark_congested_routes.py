@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+# Benchmark congested_routes_mp.py on synthetic tract grids, so that scaling problems show up before a multi-hour run
+# on the real region. Times each stage of the worker on a sample of origins, then measures overall throughput in
+# tract pairs per second with different numbers of worker processes.
+
+import numpy as np
+import geopandas as gp
+import pyarrow.parquet as pq
+import multiprocessing
+import argparse
+import tempfile
+import time
+import io
+import congested_routes_mp as cr
+import tract_data
+
+STAGES = ['index query', 'distance', 'bands', 'percentile', 'serialization']
+
+# n_tracts centroids on a jittered square grid with density tracts per square km, with random densities
+def synthetic_tracts (n_tracts, density, seed=0):
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n_tracts)))
+    spacing = 1000 / np.sqrt(density)  # meters between grid points
+    i = np.arange(n_tracts)
+    x = (i % side + rng.uniform(-0.4, 0.4, n_tracts)) * spacing
+    y = (i // side + rng.uniform(-0.4, 0.4, n_tracts)) * spacing
+
+    return gp.GeoDataFrame({
+        'GEOID': [f'{i:011d}' for i in range(n_tracts)],
+        'pop_dens_sqkm': rng.lognormal(8, 1, n_tracts),
+        'job_dens_sqkm': rng.lognormal(7, 1.5, n_tracts)
+    }, geometry=gp.points_from_xy(x, y), crs='EPSG:26911')
+
+# evenly spaced origins, skipping the end of the list where origins have few destinations
+def sample_origins (n_tracts, n):
+    return np.unique(np.linspace(0, n_tracts // 2, n).astype('int64'))
+
+# time each stage of the worker, in the current process (cr.initialize_worker must already have been called)
+def time_stages (origins):
+    times = dict.fromkeys(STAGES, 0.0)
+    n_pairs = 0
+
+    for fridx in origins:
+        toidxs = np.arange(fridx + 1, len(cr.tract_x))
+
+        start = time.perf_counter()
+        offsets, candidates = cr.origin_candidates(fridx, toidxs)
+        index_done = time.perf_counter()
+        distances = cr.origin_distances(fridx, toidxs, offsets, candidates)
+        distance_done = time.perf_counter()
+        entry_toidx, entry_band, entry_length, members = cr.assign_bands(toidxs, offsets, candidates, distances)
+        bands_done = time.perf_counter()
+        member_offsets = np.concatenate([[0], np.cumsum(entry_length)])
+        result = cr.band_percentiles(np.full(len(entry_toidx), fridx), entry_toidx, entry_band, member_offsets, members,
+            cr.tract_pop_dens, cr.tract_job_dens)
+        percentile_done = time.perf_counter()
+        pq.write_table(cr.result_table(result), io.BytesIO())
+        serialization_done = time.perf_counter()
+
+        times['index query'] += index_done - start
+        times['distance'] += distance_done - index_done
+        times['bands'] += bands_done - distance_done
+        times['percentile'] += percentile_done - bands_done
+        times['serialization'] += serialization_done - percentile_done
+        n_pairs += len(toidxs)
+
+    return times, n_pairs
+
+# set up a worker as congested_routes_mp.py does, and compile the numba kernels so compilation isn't timed
+def initialize_benchmark_worker (*args):
+    cr.initialize_worker(*args)
+    cr.origin_distances(0, np.array([1]), np.array([0, 1]), np.array([0]))
+
+def time_workers (n_workers, origins, tract_dir):
+    tasks = [(fridx, fridx + 1) for fridx in origins]
+    n_pairs = sum(len(cr.tract_x) - fridx - 1 for fridx in origins)
+
+    with multiprocessing.Pool(n_workers, initializer=initialize_benchmark_worker,
+            initargs=(tract_dir, None, cr.BAND_EDGES, cr.PERCENTILES)) as pool:
+        # make sure workers are started before timing
+        pool.map(abs, range(n_workers))
+
+        start = time.perf_counter()
+        for origin_start, origin_end, result in pool.imap_unordered(cr.run_task, tasks):
+            pq.write_table(cr.result_table(result), io.BytesIO())
+        elapsed = time.perf_counter() - start
+
+    return elapsed, n_pairs
+
+if __name__ == '__main__':
+    cpus = multiprocessing.cpu_count()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tracts', type=int, nargs='+', default=[1000, 4000], help='number of synthetic tracts (one benchmark per value)')
+    parser.add_argument('--density', type=float, default=0.5, help='synthetic tracts per square km')
+    parser.add_argument('--stage-origins', type=int, default=20, help='number of origins to time stages on')
+    parser.add_argument('--scaling-origins', type=int, default=100, help='number of origins to measure throughput on')
+    parser.add_argument('--workers', default=','.join(str(2 ** i) for i in range(cpus.bit_length()) if 2 ** i <= cpus),
+        help='comma-separated numbers of worker processes')
+    parser.add_argument('--bands', default=','.join(map(str, cr.BAND_EDGES)), help='as for congested_routes_mp.py')
+    args = parser.parse_args()
+
+    cr.configure([float(e) for e in args.bands.split(',')], cr.PERCENTILES)
+
+    for n_tracts in args.tracts:
+        with tempfile.TemporaryDirectory() as tract_dir:
+            tract_data.publish_tracts(synthetic_tracts(n_tracts, args.density), tract_dir)
+            initialize_benchmark_worker(tract_dir, None, cr.BAND_EDGES, cr.PERCENTILES)
+
+            print(f'{n_tracts:,d} tracts at {args.density} per sq km ({n_tracts * (n_tracts - 1) // 2:,d} pairs)')
+
+            times, n_pairs = time_stages(sample_origins(n_tracts, args.stage_origins))
+            total = sum(times.values())
+            print(f'  stages, one process, {n_pairs:,d} pairs:')
+            for stage in STAGES:
+                print(f'    {stage:15s} {times[stage]:8.3f} s  {times[stage] / total:6.1%}  {times[stage] / n_pairs * 1e6:8.2f} us/pair')
+            print(f'    {"total":15s} {total:8.3f} s  {n_pairs / total:,.0f} pairs/s')
+
+            print(f'  throughput:')
+            base_rate = None
+            for n_workers in map(int, args.workers.split(',')):
+                elapsed, n_pairs = time_workers(n_workers, sample_origins(n_tracts, args.scaling_origins), tract_dir)
+                rate = n_pairs / elapsed
+                if base_rate is None:
+                    base_rate = rate
+                print(f'    {n_workers:3d} workers  {rate:12,.0f} pairs/s  {rate / base_rate:5.2f}x')
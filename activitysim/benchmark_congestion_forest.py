@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# Measure how the speed of congestion prediction trades against accuracy, for the random forest in skim_rf.joblib and
+# smaller versions of it (only the first trees, or trees cut off at a maximum depth), so the model size for production
+# runs can be chosen deliberately. Features are built for tract pairs in the Uber Movement data by the same code
+# congestion_prediction_mp.worker uses, and error is measured on the observations held out when the model was fit in
+# Congestion model.ipynb.
+
+import numpy as np
+import pandas as pd
+import argparse
+import time
+import congestion_prediction_mp as cp
+import forest_inference
+import tract_data
+
+UBER_FILE = '../data/uber_with_tracts.parquet'
+
+# train/test split, as in Congestion model.ipynb
+SPLIT_SEED = 48923
+TRAIN_ROWS = 100_000
+EXCLUDED_TRACTS = 200
+
+# Uber Movement observations that were not used to fit the model, reproducing the split in Congestion model.ipynb.
+# excluded_tract is True for observations to or from one of the tracts left out of estimation entirely.
+def held_out_observations (tracts):
+    uber = pd.read_parquet(UBER_FILE)
+    uber = uber[~uber.congested_tt_ratio.isnull()].copy()  # some pairs had no overnight records
+    uber.index = uber.index.rename(['from_geoid', 'to_geoid', 'hour'])
+    uber = uber.reset_index()
+    # This one geoid is missing data in tracts, it was removed from estimation sample
+    uber = uber[(uber.to_geoid != '06037930401') & (uber.from_geoid != '06037930401')].copy()
+
+    rng = np.random.RandomState(seed=SPLIT_SEED)
+    train = np.full(len(uber), False, dtype='bool')
+    train[:TRAIN_ROWS] = True
+    rng.shuffle(train)
+
+    excluded_tracts = set(tracts.sample(EXCLUDED_TRACTS, random_state=rng).GEOID)
+    uber['excluded_tract'] = (uber.from_geoid.isin(excluded_tracts) | uber.to_geoid.isin(excluded_tracts)).to_numpy()
+    train[uber.excluded_tract.to_numpy()] = False
+
+    return uber[~train].reset_index(drop=True)
+
+# Features for the pairs in observations, read from the cached chunks in files (as listed by cp.update_chunk_cache)
+# and built with cp.chunk_features, as in the worker. Returns the features (one row per pair), the index of the hour
+# column, and the row of each observation's pair. Observations for tracts not in the tract data are dropped.
+def observation_features (observations, files):
+    n_tracts = len(cp.tract_positions)
+    from_pos = cp.tract_positions.get_indexer(observations.from_geoid)
+    to_pos = cp.tract_positions.get_indexer(observations.to_geoid)
+    found = (from_pos >= 0) & (to_pos >= 0)
+    if not found.all():
+        print(f'{np.sum(~found):,d} observations for tracts not in the tract data, skipping')
+
+    observations = observations[found]
+    pair = from_pos[found].astype('int64') * n_tracts + to_pos[found]
+    pairs, observation_pair = np.unique(pair, return_inverse=True)
+
+    features = []
+    hour_col = None
+    for chunk in np.unique(pairs // cp.CHUNK_SIZE):
+        rows = pairs[pairs // cp.CHUNK_SIZE == chunk] % cp.CHUNK_SIZE
+        from_geoid, to_geoid, chunk_features, hour_col = cp.chunk_features(files[chunk], rows)
+        features.append(chunk_features)
+
+    return observations, np.concatenate(features), hour_col, observation_pair
+
+def r2 (observed, predicted):
+    return 1 - np.sum((observed - predicted) ** 2) / np.sum((observed - np.mean(observed)) ** 2)
+
+# Time a forest on features, and measure its error on observations. Throughput is the best of repeats predictions of
+# all pairs; latency is the median time to predict the 24 hours of a single pair.
+def profile (forest, features, hour_col, observations, observation_pair, n_threads, repeats=3, latency_pairs=200):
+    # compile (only the first time), and make sure the forest arrays are in memory
+    forest_inference.predict_hourly(forest, features[:1], hour_col, n_threads=n_threads)
+
+    elapsed = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        pred = forest_inference.predict_hourly(forest, features, hour_col, n_threads=n_threads)
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    latencies = []
+    for i in np.linspace(0, len(features) - 1, min(latency_pairs, len(features))).astype('int64'):
+        start = time.perf_counter()
+        forest_inference.predict_hourly(forest, features[i:i + 1], hour_col, n_threads=n_threads)
+        latencies.append(time.perf_counter() - start)
+
+    observed = observations.congested_tt_ratio.to_numpy()
+    predicted = pred[observation_pair, observations.hour.to_numpy()]
+    excluded = observations.excluded_tract.to_numpy()
+
+    return {
+        'nodes': int(np.sum(forest_inference.node_depths(forest) >= 0)),
+        'rows_per_s': len(features) * 24 / elapsed,
+        'pair_latency_us': np.median(latencies) * 1e6,
+        'row_latency_us': np.median(latencies) * 1e6 / 24,
+        'test_r2': r2(observed, predicted),
+        'test_rmse': np.sqrt(np.mean((observed - predicted) ** 2)),
+        'test_mae': np.mean(np.abs(observed - predicted)),
+        'excluded_tract_r2': r2(observed[excluded], predicted[excluded]) if excluded.any() else np.nan
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trees', default='10,25,50', help='comma-separated numbers of trees to try (the first trees of the forest)')
+    parser.add_argument('--depths', default='8,12,16', help='comma-separated maximum depths to try')
+    parser.add_argument('--sample', type=int, default=20_000, help='number of held out tract pairs to predict')
+    parser.add_argument('--threads', type=int, default=1, help='threads to predict with (congestion_prediction_mp.py workers use 1)')
+    parser.add_argument('--output', default=None, help='also write the report to this CSV file')
+    args = parser.parse_args()
+
+    tract_centroids = tract_data.load_tract_centroids()
+    files = cp.update_chunk_cache(tract_centroids.GEOID.to_numpy())
+    cp.initialize_worker()
+
+    observations = held_out_observations(tract_centroids)
+    # a sample of pairs, with all their held out observations
+    pairs = observations[['from_geoid', 'to_geoid']].drop_duplicates()
+    pairs = pairs.sample(min(args.sample, len(pairs)), random_state=0)
+    observations = observations.merge(pairs, on=['from_geoid', 'to_geoid'])
+
+    observations, features, hour_col, observation_pair = observation_features(observations, files)
+    print(f'{len(observations):,d} held out observations for {len(features):,d} tract pairs')
+
+    forest, colnames = cp.cached_forest()
+    n_trees = len(forest['roots'])
+    variants = {f'full ({n_trees} trees)': forest}
+    for trees in map(int, args.trees.split(',')):
+        if trees < n_trees:
+            variants[f'{trees} trees'] = forest_inference.truncate_forest(forest, n_trees=trees)
+    for depth in map(int, args.depths.split(',')):
+        variants[f'depth {depth}'] = forest_inference.truncate_forest(forest, max_depth=depth)
+
+    report = pd.DataFrame({
+        name: profile(variant, features, hour_col, observations, observation_pair, args.threads)
+        for name, variant in variants.items()
+    }).T
+    report['nodes'] = report.nodes.astype('int64')
+
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:,.4g}'.format):
+        print(report)
+
+    if args.output is not None:
+        report.to_csv(args.output, index_label='model')
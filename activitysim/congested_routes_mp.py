@@ -3,11 +3,44 @@
 import pandas as pd
 import numpy as np
 import geopandas as gp
-import rtree
 import tqdm
-import shapely
+import numba
 import multiprocessing
 import csv
+import argparse
+import os
+import json
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tract_data
+import file_cache
+from glob import glob
+
+# edges of the distance bands (km), and percentiles of density computed in each band. Bands are (low, high], and
+# these defaults can be changed on the command line (see configure)
+BAND_EDGES = [0, 2, 4, 6, 8]
+PERCENTILES = [25, 50, 75, 95]
+
+# Parquet output is written in row groups of about ROW_GROUP_ROWS rows, in files of about PART_ROWS rows
+ROW_GROUP_ROWS = 1 << 20
+PART_ROWS = 1 << 24
+
+# set the band edges and percentiles. Called in the parent and in each worker, since workers may not inherit
+# globals from the parent
+def configure (band_edges, percentiles):
+    global BAND_EDGES, PERCENTILES
+    assert all(low < high for low, high in zip(band_edges[:-1], band_edges[1:])), 'band edges must be increasing'
+    BAND_EDGES = list(band_edges)
+    PERCENTILES = list(percentiles)
+
+def band_label (band):
+    return f'({BAND_EDGES[band]:g}, {BAND_EDGES[band + 1]:g}]'
+
+# the (low, high) edges of a band in km, from its label, e.g. (2.5, 4.0) for '(2.5, 4]'
+def parse_band_label (label):
+    low, high = label.strip('(]').split(',')
+    return float(low), float(high)
 
 # break a linestring for use in indexing
 def break_arc_to_bboxes (x0, y0, x1, y1, target_length):
@@ -37,70 +70,570 @@ def get_tracts_for_arc (x0, y0, x1, y1, dmax=8):
     
     return tracts
 
-def initialize_worker ():
+# distance from each point to the segment (x0, y0) - (x1, y1). This gives the same answer as
+# GeoSeries.distance(LineString(...)) for a two-point line, but works on the raw centroid coordinates so
+# we don't create millions of geometry objects.
+@numba.jit(nopython=True)
+def point_segment_distance (px, py, x0, y0, x1, y1):
+    dx = x1 - x0
+    dy = y1 - y0
+    len2 = dx * dx + dy * dy
+    out = np.empty(len(px))
+    for i in range(len(px)):
+        # position of the closest point along the segment. Same formulation as GEOS, so that points exactly at the
+        # endpoints (i.e. the origin and destination tracts) get a distance of exactly zero.
+        if len2 > 0:
+            t = ((px[i] - x0) * dx + (py[i] - y0) * dy) / len2
+        else:
+            t = 0.0
+
+        if t <= 0:
+            out[i] = ((px[i] - x0) ** 2 + (py[i] - y0) ** 2) ** 0.5
+        elif t >= 1:
+            out[i] = ((px[i] - x1) ** 2 + (py[i] - y1) ** 2) ** 0.5
+        else:
+            out[i] = abs(((y0 - py[i]) * dx - (x0 - px[i]) * dy) / len2) * len2 ** 0.5
+    return out
+
+# distances for a whole batch of pairs at once. candidates holds the candidate tract positions for all pairs
+# concatenated, and pair k's candidates are candidates[offsets[k]:offsets[k + 1]] (i.e. CSR layout). Returns
+# distances in the same layout.
+@numba.jit(nopython=True)
+def batch_point_segment_distance (px, py, offsets, candidates, x0, y0, x1, y1):
+    out = np.empty(len(candidates))
+    for k in range(len(offsets) - 1):
+        cand = candidates[offsets[k]:offsets[k + 1]]
+        out[offsets[k]:offsets[k + 1]] = point_segment_distance(px[cand], py[cand], x0[k], y0[k], x1[k], y1[k])
+    return out
+
+# percentiles of each segment of values, where segment k is values[offsets[k]:offsets[k + 1]], computed for all
+# segments at once. values is 2D and percentiles are computed separately for each column; the result has shape
+# (segments, columns, percentiles). Uses the same linear interpolation as np.percentile, and segments must not
+# be empty.
+def segment_percentiles (values, offsets, percentiles):
+    lengths = np.diff(offsets)
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+    q = np.asarray(percentiles) / 100
+    # position within each segment, then offset to position in values
+    virtual_idx = (lengths[:, None] - 1) * q[None, :]
+    frac = virtual_idx - np.floor(virtual_idx)
+    lo = offsets[:-1, None] + np.floor(virtual_idx).astype('int64')
+    hi = np.minimum(lo + 1, offsets[1:, None] - 1)
+
+    out = np.empty((len(lengths), values.shape[1], len(q)))
+    for col in range(values.shape[1]):
+        sorted_values = values[np.lexsort((values[:, col], segment)), col]
+        a = sorted_values[lo]
+        b = sorted_values[hi]
+        # same formulation as numpy uses, so results match np.percentile exactly
+        out[:, col, :] = np.where(frac >= 0.5, b - (b - a) * (1 - frac), a + (b - a) * frac)
+    return out
+
+# turn corridor memberships into one output row per pair and band: fromidx, toidx, band index, then the
+# population and job density percentiles
+def band_percentiles (fromidx, toidx, band, offsets, members, pop_dens, job_dens):
+    pcts = segment_percentiles(np.stack([pop_dens[members], job_dens[members]], axis=1), offsets, PERCENTILES)
+    return np.column_stack([fromidx, toidx, band, pcts.reshape(len(fromidx), 2 * len(PERCENTILES))]).astype('float64')
+
+# return the task along with the result so the parent knows which pairs are done
+def run_task (task):
+    return (*task, worker(task))
+
+def initialize_worker (tract_dir=tract_data.TRACT_CACHE, index_dir=None, band_edges=BAND_EDGES, percentiles=PERCENTILES):
     # ugly but set these as global variables so they remain accessible - each mp worker has separate process
     # https://stackoverflow.com/questions/10117073
-    global tract_centroids, tract_idx
-    tract_centroids = gp.read_file('tract_centroids_density.json')
+    global tract_idx, tract_x, tract_y, tract_pop_dens, tract_job_dens, corridor_index_dir
+    corridor_index_dir = index_dir
+    configure(band_edges, percentiles)
+
+    # raw coordinates and densities, memory-mapped from the copy the parent process published. Tracts are
+    # referred to by position everywhere.
+    tracts = tract_data.load_tracts(tract_dir, ['x', 'y', 'pop_dens_sqkm', 'job_dens_sqkm'])
+    tract_x = tracts['x']
+    tract_y = tracts['y']
+    tract_pop_dens = tracts['pop_dens_sqkm']
+    tract_job_dens = tracts['job_dens_sqkm']
+
+    tract_idx = tract_data.build_spatial_index(tract_x, tract_y)
+
+# Candidate tracts (from the spatial index) for the routes from origin fridx to each of toidxs, in CSR layout
+def origin_candidates (fridx, toidxs):
+    candidate_lists = [
+        np.fromiter(get_tracts_for_arc(tract_x[fridx], tract_y[fridx], tract_x[toidx], tract_y[toidx], BAND_EDGES[-1]), dtype='int64')
+        for toidx in toidxs
+    ]
+    offsets = np.zeros(len(toidxs) + 1, dtype='int64')
+    offsets[1:] = np.cumsum([len(c) for c in candidate_lists])
+    return offsets, np.concatenate(candidate_lists)
+
+# Distance from each candidate to the route from origin fridx to its destination
+def origin_distances (fridx, toidxs, offsets, candidates):
+    return batch_point_segment_distance(tract_x, tract_y, offsets, candidates,
+        np.full(len(toidxs), tract_x[fridx]), np.full(len(toidxs), tract_y[fridx]), tract_x[toidxs], tract_y[toidxs])
+
+# Split candidates into one entry per non-empty destination and band. Returns the destination, band, and number
+# of members of each entry, and the members of all entries concatenated.
+def assign_bands (toidxs, offsets, candidates, distances):
+    band_edges_m = np.array(BAND_EDGES) * 1000
+    n_bands = len(BAND_EDGES) - 1
+
+    # Assign every candidate for every destination to a band in one pass, rather than filtering once per band.
+    # side='left' puts distances in (edge[b], edge[b + 1]] in band b; -1 and n_bands are outside all bands.
+    band = np.searchsorted(band_edges_m, distances, side='left') - 1
+    pair = np.repeat(np.arange(len(toidxs)), np.diff(offsets))
+    in_band = (band >= 0) & (band < n_bands)
+
+    # sort candidates by pair and band, and split into one entry per non-empty pair/band
+    key = pair[in_band] * n_bands + band[in_band]
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+    entries, starts = np.unique(key, return_index=True)
+
+    return toidxs[entries // n_bands], entries % n_bands, np.diff(np.append(starts, len(key))), candidates[in_band][order]
 
-    # build a spatial index
-    tract_idx = rtree.index.Index()
-    for idx, x, y in zip(tract_centroids.index, tract_centroids.geometry.x, tract_centroids.geometry.y):
-        tract_idx.insert(idx, (x, y, x, y))
+# Find the tracts in each distance band along the routes from each origin in [origin_start, origin_end) to every
+# destination with a higher index. Returns fromidx, toidx and band arrays with one entry per non-empty pair and
+# band, and the member tracts of each entry in CSR layout (entry k's members are members[offsets[k]:offsets[k + 1]]).
+# This is the only geometric part of the computation, and doesn't depend on densities.
+def corridor_members (origin_start, origin_end):
+    fromidxs = []
+    toidxs_out = []
+    bands = []
+    entry_lengths = []
+    member_lists = []
 
+    for fridx in range(origin_start, origin_end):
+        toidxs = np.arange(fridx + 1, len(tract_x))
+        if len(toidxs) == 0:
+            continue
+
+        offsets, candidates = origin_candidates(fridx, toidxs)
+        distances = origin_distances(fridx, toidxs, offsets, candidates)
+        entry_toidx, entry_band, entry_length, members = assign_bands(toidxs, offsets, candidates, distances)
+
+        fromidxs.append(np.full(len(entry_toidx), fridx))
+        toidxs_out.append(entry_toidx)
+        bands.append(entry_band)
+        entry_lengths.append(entry_length)
+        member_lists.append(members)
+
+    if len(fromidxs) == 0:
+        # only the last origin, which has no destinations with a higher index
+        fromidxs = toidxs_out = bands = entry_lengths = member_lists = [np.zeros(0, dtype='int64')]
+
+    offsets = np.zeros(sum(len(l) for l in entry_lengths) + 1, dtype='int64')
+    offsets[1:] = np.cumsum(np.concatenate(entry_lengths))
+
+    return (np.concatenate(fromidxs).astype('int32'), np.concatenate(toidxs_out).astype('int32'),
+        np.concatenate(bands).astype('int8'), offsets, np.concatenate(member_lists).astype('int32'))
+
+# Each task is a block of origins [origin_start, origin_end), and covers every pair from those origins to all
+# destinations with a higher index. This keeps the number of pickled messages proportional to the number of
+# tracts rather than the number of pairs. Results come back as a single float array (see band_percentiles).
+# If a corridor index directory is set, the memberships are also saved there so features can later be
+# recomputed for new densities without redoing the geometry (see reaggregate).
 def worker (task):
-    fridx, toidx, frx, fry, tox, toy = task
-    band_results = []
+    fromidx, toidx, band, offsets, members = corridor_members(*task)
+
+    if corridor_index_dir is not None:
+        file_cache.write_atomic(index_block_filename(corridor_index_dir, *task), lambda tmp: np.savez(tmp,
+            fromidx=fromidx, toidx=toidx, band=band, offsets=offsets, members=members))
+
+    return band_percentiles(fromidx, toidx, band, offsets, members, tract_pop_dens, tract_job_dens)
+
+def index_block_filename (index_dir, origin_start, origin_end):
+    return os.path.join(index_dir, f'origins_{origin_start}_{origin_end}.npz')
+
+def index_layout_filename (index_dir, first_origin, last_origin):
+    return os.path.join(index_dir, f'layout_{first_origin}_{last_origin}.json')
+
+# origin ranges (start, end) of the files in index_dir matching pattern, e.g. origins_*.npz
+def index_ranges (index_dir, pattern):
+    return {(tuple(map(int, os.path.splitext(os.path.basename(filename))[0].split('_')[1:])), filename)
+        for filename in glob(os.path.join(index_dir, pattern))}
+
+# Prepare index_dir for a corridor index of the origin blocks of a run (origins_per_task origins per block, from
+# first_origin to last_origin). The index records the tracts and band edges it was built with, and the block layout of
+# each run that wrote to it, so --shard runs can share one index directory (or have their directories copied into one
+# afterwards). Unless resuming, blocks and layouts left in this run's range of origins from an earlier run are removed
+# first (everything, if the tracts or band edges have changed), so blocks from a different layout are never mixed in.
+def open_corridor_index (index_dir, geoids, origins_per_task, first_origin, last_origin, resume=False):
+    layout = {'origins_per_task': origins_per_task, 'first_origin': first_origin, 'last_origin': last_origin,
+        'n_tracts': len(geoids)}
+    layout_file = index_layout_filename(index_dir, first_origin, last_origin)
+    geoids_file = os.path.join(index_dir, 'geoids.npy')
+    band_edges_file = os.path.join(index_dir, 'band_edges.npy')
+    same_tracts = os.path.exists(geoids_file) and np.array_equal(np.load(geoids_file), np.asarray(geoids, dtype=str))
+    same_bands = os.path.exists(band_edges_file) and np.array_equal(np.load(band_edges_file), BAND_EDGES)
+
+    if resume and os.path.exists(layout_file):
+        assert file_cache.load_json(layout_file) == layout, f'block layout of {index_dir} does not match the run being resumed'
+        assert same_tracts, f'tracts in {index_dir} do not match the run being resumed'
+        assert same_bands, f'band edges in {index_dir} do not match the run being resumed'
+        return
+
+    if os.path.exists(index_dir):
+        stale = [filename for pattern in ['origins_*.npz', 'layout_*.json']
+            for (start, end), filename in index_ranges(index_dir, pattern)
+            if not (same_tracts and same_bands) or (start < last_origin and end > first_origin)]
+        for filename in stale:
+            os.remove(filename)
+    os.makedirs(index_dir, exist_ok=True)
+    if not same_tracts:
+        file_cache.save_npy(geoids_file, np.asarray(geoids, dtype=str))
+    if not same_bands:
+        file_cache.save_npy(band_edges_file, np.array(BAND_EDGES))
+    # written last, so an index that was only partly cleared can't be resumed
+    file_cache.save_json(layout_file, layout)
+
+# The origin blocks in a corridor index, checking that the layouts of the runs that wrote it cover every origin exactly
+# once, and that the blocks are exactly the blocks of those layouts
+def index_blocks (index_dir):
+    layouts = sorted((file_cache.load_json(filename) for filename in glob(os.path.join(index_dir, 'layout_*.json'))),
+        key=lambda layout: layout['first_origin'])
+    assert len(layouts) > 0, f'{index_dir} has no layout files, rebuild it with --corridor-index'
+
+    n_tracts = layouts[0]['n_tracts']
+    expected = set()
+    expected_start = 0
+    for layout in layouts:
+        first_origin, last_origin, per_task = layout['first_origin'], layout['last_origin'], layout['origins_per_task']
+        assert layout['n_tracts'] == n_tracts, f'{index_dir} has layouts for different numbers of tracts'
+        assert first_origin == expected_start, f'origins {expected_start}-{first_origin} missing or duplicated in {index_dir}'
+        expected.update((start, min(start + per_task, last_origin)) for start in range(first_origin, last_origin, per_task))
+        expected_start = last_origin
+    assert expected_start == n_tracts, f'origins {expected_start}-{n_tracts} missing from {index_dir}'
+
+    found = {block for block, filename in index_ranges(index_dir, 'origins_*.npz')}
+    assert found <= expected, f'{len(found - expected):,d} blocks in {index_dir} are not in its layouts'
+    assert found == expected, f'{len(expected - found):,d} origin blocks missing from {index_dir}, finish it with --resume'
+    return sorted(expected)
+
+# Recompute along-route features from a saved corridor index for new tract densities (e.g. a land use scenario).
+# No spatial queries, just percentiles. Yields origin_start, origin_end, and a result array in the same format as
+# worker for each origin block, except those in skip.
+def reaggregate (index_dir, pop_dens, job_dens, skip=()):
+    for origin_start, origin_end in index_blocks(index_dir):
+        if (origin_start, origin_end) in skip:
+            continue
+        idx = np.load(index_block_filename(index_dir, origin_start, origin_end))
+        yield origin_start, origin_end, band_percentiles(idx['fromidx'], idx['toidx'], idx['band'], idx['offsets'],
+            idx['members'], pop_dens, job_dens)
+
+# read a table of tract densities for reaggregation, and put it in the same order as the tracts in the index
+def read_densities (filename, geoids):
+    if filename.endswith('.parquet'):
+        densities = pd.read_parquet(filename)
+    elif filename.endswith('.csv'):
+        densities = pd.read_csv(filename, dtype={'GEOID': str})
+    else:
+        densities = gp.read_file(filename)
 
-    candidate_tracts = tract_centroids.loc[get_tracts_for_arc(frx, fry, tox, toy, 8)]
+    densities = densities.set_index('GEOID').reindex(geoids)
+    assert not densities.pop_dens_sqkm.isnull().any(), 'some population densities missing'
+    assert not densities.job_dens_sqkm.isnull().any(), 'some job densities missing'
+    return densities.pop_dens_sqkm.to_numpy(), densities.job_dens_sqkm.to_numpy()
 
-    if len(candidate_tracts) > 0:
-        ls = shapely.geometry.LineString(((frx, fry), (tox, toy)))
-        distances = candidate_tracts.distance(ls)
+def value_columns ():
+    return [*[f'pop_dens_sqkm_{pct}' for pct in PERCENTILES], *[f'job_dens_sqkm_{pct}' for pct in PERCENTILES]]
 
-        for low, high in [(0, 2), (2, 4), (4, 6), (6, 8)]:
-            tracts_in_dist = candidate_tracts[(distances > ((low * 1000))) & (distances <= ((high * 1000)))]
-            if len(tracts_in_dist) == 0:
-                continue
+# the GEOID lookup table that goes with a Parquet output, e.g. along_route_tracts.parquet for along_route.parquet
+def tract_table_filename (filename):
+    return os.path.splitext(filename.rstrip('/'))[0] + '_tracts.parquet'
 
-            band_results.append((fridx, toidx, f'({low}, {high}]', 
-                *np.percentile(tracts_in_dist.pop_dens_sqkm, [25, 50, 75, 95]),
-                *np.percentile(tracts_in_dist.job_dens_sqkm, [25, 50, 75, 95]),
-                ))
+# Convert a result array to an Arrow table. Tracts are stored as integer indexes (fromidx, toidx) and bands are
+# dictionary-encoded, with the GEOIDs for the indexes in a separate lookup table, so the parent process does no
+# per-row work.
+def result_schema ():
+    return pa.schema([
+        ('fromidx', pa.int32()),
+        ('toidx', pa.int32()),
+        ('band', pa.dictionary(pa.int8(), pa.string())),
+        *[(col, pa.float64()) for col in value_columns()]
+    ])
 
-    return band_results
+def result_table (result):
+    band_labels = pa.array([band_label(band) for band in range(len(BAND_EDGES) - 1)])
+    return pa.Table.from_arrays([
+        pa.array(result[:, 0].astype('int32')),
+        pa.array(result[:, 1].astype('int32')),
+        pa.DictionaryArray.from_arrays(pa.array(result[:, 2].astype('int8')), band_labels),
+        *[pa.array(result[:, i]) for i in range(3, result.shape[1])]
+    ], schema=result_schema())
+
+# remove a Parquet output left from an earlier run (parts, temporary files and manifest) from directory, creating it if
+# it doesn't exist
+def clear_parquet_output (directory):
+    if os.path.exists(directory):
+        for filename in [*glob(os.path.join(directory, '*.parquet')), *glob(os.path.join(directory, '.part_*.tmp')),
+                os.path.join(directory, '_complete.txt'), os.path.join(directory, '_settings.json')]:
+            if os.path.exists(filename):
+                os.remove(filename)
+    os.makedirs(directory, exist_ok=True)
+
+def part_filename (part):
+    return f'part_{part:05d}.parquet'
+
+# Parquet output is a directory of part files (i.e. a Parquet dataset, which pd.read_parquet reads as a single table),
+# plus a manifest of completed origin blocks and the part each is in. Results are buffered and written as row groups of
+# about ROW_GROUP_ROWS rows, and a part is finished after PART_ROWS rows, so the number of files depends on the size of
+# the output rather than the number of tasks. A part is written to a temporary file and renamed, and only then are its
+# blocks added to the manifest, so a block in the manifest is always complete. If the run dies partway through,
+# rerunning with resume only computes the blocks that are not in the manifest (at most a part's worth).
+class ShardedParquetWriter:
+    def __init__ (self, directory, geoids, settings, resume=False):
+        self.directory = directory
+        self.completed = set()
+        settings_file = os.path.join(directory, '_settings.json')
+        manifest_file = os.path.join(directory, '_complete.txt')
+        parts = set()
+
+        if resume and os.path.exists(settings_file):
+            with open(settings_file) as f:
+                assert json.load(f) == settings, f'settings do not match the run being resumed ({settings_file})'
+            if os.path.exists(manifest_file):
+                with open(manifest_file) as f:
+                    for line in f:
+                        if line.strip():
+                            origin_start, origin_end, part = line.split()
+                            self.completed.add((int(origin_start), int(origin_end)))
+                            parts.add(part)
+            # parts that were unfinished, or renamed but not yet in the manifest, when the run died. Their blocks are
+            # computed again.
+            for filename in [*glob(os.path.join(directory, '*.parquet')), *glob(os.path.join(directory, '.part_*.tmp'))]:
+                if os.path.basename(filename) not in parts:
+                    os.remove(filename)
+            print(f'Resuming, {len(self.completed):,d} origin blocks already complete')
+        else:
+            # starting over, clear out anything left from a previous run
+            clear_parquet_output(directory)
+            with open(settings_file, 'w') as f:
+                json.dump(settings, f)
+            pq.write_table(pa.table({'idx': np.arange(len(geoids), dtype='int32'), 'geoid': np.asarray(geoids, dtype=str)}),
+                tract_table_filename(directory))
+
+        self.manifest = open(manifest_file, 'a')
+        self.next_part = max((int(part[len('part_'):-len('.parquet')]) for part in parts), default=-1) + 1
+        # results not yet written, and the part being written
+        self.buffer = []
+        self.buffered_rows = 0
+        self.part_writer = None
+        self.part_blocks = []
+        self.part_rows = 0
+
+    def write (self, origin_start, origin_end, result):
+        self.buffer.append(result)
+        self.buffered_rows += len(result)
+        self.part_blocks.append((origin_start, origin_end))
+        if self.buffered_rows >= ROW_GROUP_ROWS:
+            self.write_row_group()
+        if self.part_rows >= PART_ROWS:
+            self.finish_part()
+
+    def part_tmp (self):
+        # leading . so the temporary file is not picked up as part of the dataset
+        return os.path.join(self.directory, f'.{part_filename(self.next_part)}.tmp')
+
+    def write_row_group (self):
+        if self.part_writer is None:
+            self.part_writer = pq.ParquetWriter(self.part_tmp(), result_schema())
+        if self.buffered_rows > 0:
+            self.part_writer.write_table(result_table(np.concatenate(self.buffer)), row_group_size=self.buffered_rows)
+        self.part_rows += self.buffered_rows
+        self.buffer = []
+        self.buffered_rows = 0
+
+    def finish_part (self):
+        if len(self.part_blocks) == 0:
+            return
+        self.write_row_group()
+        self.part_writer.close()
+        part = part_filename(self.next_part)
+        os.replace(self.part_tmp(), os.path.join(self.directory, part))
+
+        for origin_start, origin_end in self.part_blocks:
+            self.manifest.write(f'{origin_start} {origin_end} {part}\n')
+        self.manifest.flush()
+        os.fsync(self.manifest.fileno())
+        self.completed.update(self.part_blocks)
+
+        self.next_part += 1
+        self.part_writer = None
+        self.part_blocks = []
+        self.part_rows = 0
+
+    def close (self):
+        self.finish_part()
+        self.manifest.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close()
+
+# Original CSV format, with GEOIDs on every row
+class CsvResultWriter:
+    def __init__ (self, filename, geoids):
+        self.completed = set()
+        self.geoids = geoids
+        self.output = open(filename, 'w')
+        self.writer = csv.writer(self.output)
+        self.writer.writerow(['fromidx', 'toidx', 'band', *value_columns(), 'from_geoid', 'to_geoid'])
+
+    def write (self, origin_start, origin_end, result):
+        for row in result:
+            fridx, toidx, band = int(row[0]), int(row[1]), int(row[2])
+            self.writer.writerow((fridx, toidx, band_label(band), *row[3:], self.geoids[fridx], self.geoids[toidx]))
+
+    def close (self):
+        self.output.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close()
+
+# Split the origins into n_parts contiguous ranges with roughly equal numbers of tract pairs, for running on
+# several nodes. Origin i has n_tracts - i - 1 destinations, so splitting by number of origins would give the
+# first part far more work than the last.
+def partition_origins (n_tracts, n_parts):
+    # pairs_before[i] is the number of pairs with an origin before i
+    pairs_before = np.concatenate([[0], np.cumsum(np.arange(n_tracts - 1, -1, -1))])
+    bounds = np.searchsorted(pairs_before, np.arange(n_parts + 1) * pairs_before[-1] / n_parts)
+    bounds[0] = 0
+    bounds[-1] = n_tracts
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+# Merge Parquet outputs from several --shard runs into one output directory, replacing anything already there. Checks
+# that all inputs were run with the same settings and that together they cover every origin exactly once.
+def merge_outputs (inputs, output):
+    assert not any(os.path.abspath(output) == os.path.abspath(directory) for directory in inputs), \
+        'the merged output must be a new directory'
+    settings = None
+    blocks = []
+    for directory in inputs:
+        with open(os.path.join(directory, '_settings.json')) as f:
+            input_settings = json.load(f)
+        input_settings.pop('shard', None)
+        assert settings is None or input_settings == settings, f'settings for {directory} do not match {inputs[0]}'
+        settings = input_settings
+
+        with open(os.path.join(directory, '_complete.txt')) as f:
+            for line in f:
+                if line.strip():
+                    origin_start, origin_end, part = line.split()
+                    blocks.append(((int(origin_start), int(origin_end)), directory, part))
+
+    blocks.sort()
+    n_tracts = len(pd.read_parquet(tract_table_filename(inputs[0])))
+    expected_start = 0
+    for (origin_start, origin_end), directory, part in blocks:
+        assert origin_start == expected_start, f'origins {expected_start}-{origin_start} missing or duplicated (at {directory})'
+        expected_start = origin_end
+    assert expected_start == n_tracts, f'origins {expected_start}-{n_tracts} missing'
+
+    clear_parquet_output(output)
+    shutil.copy(tract_table_filename(inputs[0]), tract_table_filename(output))
+    with open(os.path.join(output, '_settings.json'), 'w') as f:
+        json.dump(settings, f)
+
+    # parts are renumbered, since each input numbers its own from 0
+    parts = {}
+    with open(os.path.join(output, '_complete.txt'), 'w') as manifest:
+        for (origin_start, origin_end), directory, part in tqdm.tqdm(blocks):
+            if (directory, part) not in parts:
+                parts[directory, part] = part_filename(len(parts))
+                shutil.copy(os.path.join(directory, part), os.path.join(output, parts[directory, part]))
+            manifest.write(f'{origin_start} {origin_end} {parts[directory, part]}\n')
+
+def open_result_writer (filename, geoids, settings, resume=False):
+    if filename.endswith('.csv'):
+        assert not resume, 'resuming requires Parquet output'
+        return CsvResultWriter(filename, geoids)
+    else:
+        return ShardedParquetWriter(filename, geoids, settings, resume)
 
 if __name__ == '__main__':
-    tract_centroids = gp.read_file('tract_centroids_density.json')
-
-    # generator comprehension, everything is lazy
-    tasks = (
-        (fridx, toidx, frx, fry, tox, toy)
-        for fri, fridx, frx, fry in zip(range(len(tract_centroids.index)), tract_centroids.index, tract_centroids.geometry.x, tract_centroids.geometry.y)
-        for toidx, tox, toy in zip(tract_centroids.index[fri + 1:], tract_centroids.geometry.iloc[fri + 1:].x, tract_centroids.geometry.iloc[fri + 1:].y)
-    )
-
-    pool = multiprocessing.Pool(multiprocessing.cpu_count(), initializer=initialize_worker)
-
-    total_length = int(len(tract_centroids) * (len(tract_centroids) - 1) / 2)
-
-    print(f'Parallelizing {total_length:,d} tasks over {multiprocessing.cpu_count()} processes')
-
-    # flatten results
-    with open('along_route.csv', 'w') as output:
-        writer = csv.writer(output)
-        writer.writerow(['fromidx', 'toidx', 'band', 'pop_dens_sqkm_25',
-                    'pop_dens_sqkm_50',
-                    'pop_dens_sqkm_75',
-                    'pop_dens_sqkm_95',
-                    'job_dens_sqkm_25',
-                    'job_dens_sqkm_50',
-                    'job_dens_sqkm_75',
-                    'job_dens_sqkm_95',
-                    'from_geoid',
-                    'to_geoid'])
-
-        for result in tqdm.tqdm(pool.imap_unordered(worker, tasks, 100), total=total_length):
-            for row in result:
-                row = (*row, tract_centroids.loc[row[0], 'GEOID'], tract_centroids.loc[row[1], 'GEOID'])
-                writer.writerow(row)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--origins-per-task', type=int, default=1,
+        help='number of origin tracts sent to a worker at once (each covers all higher-numbered destinations)')
+    parser.add_argument('--corridor-index', default=None,
+        help='directory to save which tracts are in each distance band of each pair, for use with --reaggregate')
+    parser.add_argument('--reaggregate', default=None, metavar='DENSITIES',
+        help='recompute features from the --corridor-index for the tract densities in this file (GeoJSON, CSV, or Parquet) instead of the full computation')
+    parser.add_argument('--bands', default=','.join(map(str, BAND_EDGES)),
+        help='comma-separated edges of the distance bands in km, e.g. 0,1,2,3,4,5,6,7,8,9,10 for 1 km bands out to 10 km')
+    parser.add_argument('--percentiles', default=','.join(map(str, PERCENTILES)),
+        help='comma-separated percentiles of density to compute in each band')
+    parser.add_argument('--output', default='along_route.parquet',
+        help='output Parquet dataset directory (with a separate _tracts.parquet GEOID table), or a single CSV file if the name ends in .csv')
+    parser.add_argument('--resume', action='store_true',
+        help='continue an interrupted run, only computing origin blocks not already in the output')
+    parser.add_argument('--shard', default=None, metavar='K/N',
+        help='only compute part K (counting from 0) of N parts with roughly equal numbers of pairs, e.g. to run on N nodes')
+    parser.add_argument('--merge', nargs='+', default=None, metavar='DIR',
+        help='merge the outputs of --shard runs into --output, rather than computing anything')
+    args = parser.parse_args()
+
+    configure([float(e) for e in args.bands.split(',')], [float(p) if '.' in p else int(p) for p in args.percentiles.split(',')])
+
+    if args.merge is not None:
+        print(f'Merging {len(args.merge)} outputs into {args.output}')
+        merge_outputs(args.merge, args.output)
+
+    elif args.reaggregate is not None:
+        assert args.corridor_index is not None, '--reaggregate requires --corridor-index'
+        geoids = np.load(os.path.join(args.corridor_index, 'geoids.npy'))
+        # bands are fixed when the index is built
+        configure(np.load(os.path.join(args.corridor_index, 'band_edges.npy')), PERCENTILES)
+        pop_dens, job_dens = read_densities(args.reaggregate, geoids)
+
+        print(f'Reaggregating along-route features for {len(geoids):,d} tracts from {args.corridor_index}')
+
+        settings = {'reaggregate': args.reaggregate, 'band_edges': BAND_EDGES, 'percentiles': PERCENTILES,
+            'geoids_sha256': tract_data.geoid_hash(geoids)}
+        with open_result_writer(args.output, geoids, settings, args.resume) as writer:
+            for origin_start, origin_end, result in tqdm.tqdm(reaggregate(args.corridor_index, pop_dens, job_dens, writer.completed)):
+                writer.write(origin_start, origin_end, result)
+
+    else:
+        # parsed at most once (and not at all if the cache is current), workers memory-map the cached columns
+        tract_centroids = tract_data.load_tract_centroids()
+        n_tracts = len(tract_centroids)
+        geoids = tract_centroids.GEOID.to_numpy()
+
+        if args.shard is not None:
+            shard, n_shards = map(int, args.shard.split('/'))
+            assert 0 <= shard < n_shards, '--shard must be K/N with 0 <= K < N'
+            first_origin, last_origin = partition_origins(n_tracts, n_shards)[shard]
+        else:
+            first_origin, last_origin = 0, n_tracts
+
+        if args.corridor_index is not None:
+            open_corridor_index(args.corridor_index, geoids, args.origins_per_task, first_origin, last_origin, args.resume)
+
+        settings = {'origins_per_task': args.origins_per_task, 'band_edges': BAND_EDGES, 'percentiles': PERCENTILES,
+            'shard': args.shard, 'geoids_sha256': tract_data.geoid_hash(geoids)}
+        with open_result_writer(args.output, geoids, settings, args.resume) as writer:
+            # skip origin blocks finished before an interruption
+            tasks = [
+                (origin_start, min(origin_start + args.origins_per_task, last_origin))
+                for origin_start in range(first_origin, last_origin, args.origins_per_task)
+            ]
+            tasks = (task for task in tasks if task not in writer.completed)
+
+            pool = multiprocessing.Pool(multiprocessing.cpu_count(), initializer=initialize_worker,
+                initargs=(tract_data.TRACT_CACHE, args.corridor_index, BAND_EDGES, PERCENTILES))
+
+            total_length = sum(n_tracts - fridx - 1 for fridx in range(first_origin, last_origin))
+            done_length = sum(n_tracts - fridx - 1 for origin_start, origin_end in writer.completed for fridx in range(origin_start, origin_end))
+
+            print(f'Parallelizing {total_length - done_length:,d} tract pairs over {multiprocessing.cpu_count()} processes, {args.origins_per_task} origin(s) per task')
+
+            with tqdm.tqdm(total=total_length, initial=done_length) as pbar:
+                for origin_start, origin_end, result in pool.imap_unordered(run_task, tasks):
+                    writer.write(origin_start, origin_end, result)
+                    # progress is in pairs, not tasks, since early origins have many more destinations
+                    pbar.update(sum(n_tracts - fridx - 1 for fridx in range(origin_start, origin_end)))
@@ -5,156 +5,699 @@ import numpy as np
 import sklearn.ensemble
 import multiprocessing
 import tqdm
-import datetime
-import openmatrix as omx
-import geopandas as gp
 import joblib
+import argparse
+import json
 import os
-from itertools import product
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+import openmatrix as omx
+import tract_data
+import file_cache
+import skim_access
+import forest_inference
+import congested_routes_mp
 from glob import glob
 
 
-MULTIPROCESS = False
+# predict with the compiled forest engine in forest_inference.py rather than rf.predict (same predictions, much faster)
+USE_COMPILED_FOREST = True
 
 # chunk size is in tract pairs, not in 
 CHUNK_SIZE = 1_000 
 
-# Initialization function for worker
-def initialize_worker ():
-    # None of this stuff should be huge. While it may be shareable, better to just have process-local copies
-    global tract_centroids, rf, car_tt, netdist, colnames
-    tract_centroids = gp.read_file('tract_centroids_density.json')
+CACHE_DIR = 'congestion_cache'
+ALONG_ROUTE_FILE = '../data/along_route.parquet'
+# increment when the way chunks are built changes, so caches built by older versions are not reused
+CACHE_VERSION = 2
+# rows of along_route read at once when building the cache
+BATCH_ROWS = 1_000_000
+
+MODEL_FILE = '../data/skim_rf.joblib'
+# exported copy of the forest in MODEL_FILE, memory-mapped by all workers
+FOREST_CACHE = 'forest_cache'
+# tract densities for a --delta scenario, in tract order, memory-mapped by all workers
+DENSITY_CACHE = 'density_cache'
+# memory used by each worker process for the interpreter and libraries, before any data is loaded
+WORKER_BASE_MEMORY = 400 * 2 ** 20
+
+# ActivitySim time periods, as (first hour, last hour + 1), as in Assemble Skims.ipynb
+TIME_PERIODS = {
+    'EA': (3, 5),
+    'AM': (5, 9),
+    'MD': (9, 14),
+    'PM': (14, 18),
+    'EV': (18, 24)
+}
+
+# The random forest exported for forest_inference (as memory-mapped arrays) and its feature names. The forest is
+# exported once to cache_dir and reused until the model file changes, so workers share one copy of the arrays rather
+# than each loading the model.
+def cached_forest (model_file=MODEL_FILE, cache_dir=FOREST_CACHE):
+    def build ():
+        print(f'exporting {model_file} to {cache_dir}')
+        rf, colnames = joblib.load(model_file)
+        forest_inference.save_forest(forest_inference.export_forest(rf), cache_dir)
+        return {'colnames': list(colnames)}
+
+    stamp = file_cache.update_cache(model_file, os.path.join(cache_dir, 'source.json'), build,
+        settings={'format': forest_inference.FOREST_FORMAT})
+    return forest_inference.load_forest(cache_dir), list(stamp['colnames'])
+
+# Tract densities for a land use scenario from densities_file (as for congested_routes_mp.py --reaggregate), as
+# memory-mapped arrays in the order of geoids. The file is read once, by the main process, and cached in cache_dir until
+# it or the tracts change, so workers don't each parse it again.
+def cached_densities (densities_file, geoids, cache_dir=DENSITY_CACHE):
+    def build ():
+        print(f'caching {densities_file} in {cache_dir}')
+        pop_dens, job_dens = congested_routes_mp.read_densities(densities_file, geoids)
+        file_cache.save_npy(os.path.join(cache_dir, 'pop_dens_sqkm.npy'), pop_dens)
+        file_cache.save_npy(os.path.join(cache_dir, 'job_dens_sqkm.npy'), job_dens)
+
+    file_cache.update_cache(densities_file, os.path.join(cache_dir, 'source.json'), build, check_hash=True,
+        settings={'geoids_sha256': tract_data.geoid_hash(geoids)})
+    return tract_data.load_tracts(cache_dir, ['pop_dens_sqkm', 'job_dens_sqkm'])
+
+# Initialization function for worker. density_dir is a cache of tract densities for a land use scenario (see
+# cached_densities) to use in place of those in the tract data.
+def initialize_worker (tract_dir=tract_data.TRACT_CACHE, n_threads=None, density_dir=None):
+    # the forest, skims and tract data are all memory-mapped from files, so all workers share one copy
+    global tract_positions, tract_columns, rf, forest, predict_threads, skims, colnames
+    # memory-mapped from the copy the main process published, rather than parsing the GeoJSON again
+    tract_centroids = tract_data.tract_frame(tract_dir)
+    if density_dir is not None:
+        for col, values in tract_data.load_tracts(density_dir, ['pop_dens_sqkm', 'job_dens_sqkm']).items():
+            tract_centroids[col] = values
     # divide by zero issues
     tract_centroids.loc[tract_centroids.aland < 1e-5, ['pop_dens_sqkm', 'job_dens_sqkm']] = 0
 
-    rf, colnames = joblib.load('../data/skim_rf.joblib')
-
-    skims = omx.open_file('../la_abm/data/skims.omx')
-    skim_idx = pd.read_parquet('../la_abm/data/skim_tracts.parquet')
-
-    car_tt = pd.DataFrame(np.array(skims['car_freeflow']), columns=skim_idx.geoid, index=skim_idx.geoid).stack().rename('car_freeflow_tt')
-    car_tt.index = car_tt.index.rename(['from_geoid', 'to_geoid'])
-
-    netdist = pd.DataFrame(np.array(skims['car_distance_km']), columns=skim_idx.geoid, index=skim_idx.geoid).stack().rename('car_net_dist')
-    netdist.index = netdist.index.rename(['from_geoid', 'to_geoid'])
-
-    skims.close()
-
-# Actual worker function (called with a chunk of along_route.csv)
-def worker (filename):
-    chunk = pd.read_parquet(filename)
-    chunk = chunk.rename(columns='along_route_{}'.format).reset_index()
-
-    # merge in origin and destination characteristics
-    chunk = chunk.merge(
-        tract_centroids.drop(columns=['aland', 'total_pop', 'NAME', 'state', 'county', 'tract', 'tract_geoid', 'total_jobs', 'geometry'])\
-            .rename(columns='from_{}'.format),
-        left_on='from_geoid',
-        right_on='from_GEOID',
-        how='left',
-        validate='m:1'
-    )
-
-    chunk = chunk.merge(
-        tract_centroids.drop(columns=['aland', 'total_pop', 'NAME', 'state', 'county', 'tract', 'tract_geoid', 'total_jobs', 'geometry'])\
-            .rename(columns='to_{}'.format),
-        left_on='to_geoid',
-        right_on='to_GEOID',
-        how='left',
-        validate='m:1'
-    )
-
-
-    # merge in travel times
-    chunk = chunk.set_index(['from_geoid', 'to_geoid'])
-
-    chunk['car_freeflow_tt'] = car_tt.reindex(chunk.index)
-    chunk['car_net_dist'] = netdist.reindex(chunk.index)
-
-    # make sure nothing unexpected is null
-    assert not chunk.to_job_dens_sqkm.isnull().any(), 'some to job densities null'
-    assert not chunk.from_job_dens_sqkm.isnull().any(), 'some from job densities null'
-    # okay for some bands to be null, no tracts in band
-    assert not chunk.car_freeflow_tt.isnull().any(), 'some freeflow times null'
-    assert not chunk.car_net_dist.isnull().any(), 'some distances null'
-
-    # fill expected nulls
-    chunk = chunk.fillna(-1)
-
-    # broadcast to one record per hour
-    n_pairs = len(chunk)
-    chunk = chunk.iloc[np.repeat(np.arange(n_pairs), 24)].copy()
-    chunk['hour'] = np.tile(np.arange(24), n_pairs)
+    # tract characteristics as arrays indexed by tract position
+    tract_positions = pd.Index(tract_centroids.GEOID)
+    tract_columns = {col: tract_centroids[col].to_numpy() for col in tract_centroids.columns
+        if pd.api.types.is_numeric_dtype(tract_centroids[col])}
 
-    # extract estimation data
-    est_data = chunk[colnames]
+    if USE_COMPILED_FOREST:
+        rf = None
+        forest, colnames = cached_forest()
+    else:
+        # each worker has its own copy of the model
+        rf, colnames = joblib.load(MODEL_FILE)
+        forest = None
+    predict_threads = n_threads
+
+    # matrices are memory-mapped from a cache shared by all workers, and only read when first used
+    skims = skim_access.Skims()
+
+# Build the feature matrix for a chunk of tract pairs directly from arrays, with one float32 row per pair and columns
+# in the order of colnames, rather than merging DataFrames. Returns the features and the index of the hour column
+# (which is left as zero), or None if the model doesn't use hour.
+def build_pair_features (along_route, from_pos, to_pos, from_skim, to_skim):
+    n_pairs = len(from_pos)
+    car_tt = skims.gather('car_freeflow', from_skim, to_skim)
+    netdist = skims.gather('car_distance_km', from_skim, to_skim)
+    pair_features = np.empty((n_pairs, len(colnames)), dtype='float32')
+    hour_col = None
+
+    for j, col in enumerate(colnames):
+        if col == 'hour':
+            hour_col = j
+            pair_features[:, j] = 0
+        elif col == 'car_freeflow_tt':
+            pair_features[:, j] = car_tt
+        elif col == 'car_net_dist':
+            pair_features[:, j] = netdist
+        elif col.startswith('along_route_'):
+            values = along_route[col[len('along_route_'):]].to_numpy()
+            # fill expected nulls (okay for some bands to be null, no tracts in band)
+            pair_features[:, j] = np.where(np.isnan(values), -1, values)
+        elif col.startswith('from_'):
+            pair_features[:, j] = tract_columns[col[len('from_'):]][from_pos]
+            # make sure nothing unexpected is null
+            assert not np.isnan(pair_features[:, j]).any(), f'some {col} null'
+        elif col.startswith('to_'):
+            pair_features[:, j] = tract_columns[col[len('to_'):]][to_pos]
+            assert not np.isnan(pair_features[:, j]).any(), f'some {col} null'
+        else:
+            raise ValueError(f'do not know how to compute feature {col}')
+
+    assert not np.isnan(car_tt).any(), 'some freeflow times null'
+    assert not np.isnan(netdist).any(), 'some distances null'
+
+    return pair_features, hour_col
+
+# Broadcast pair features to one record per pair and hour, rather than copying each row 24 times
+def broadcast_hours (pair_features, hour_col):
+    n_pairs = len(pair_features)
+    features = np.empty((n_pairs, 24, len(colnames)), dtype='float32')
+    features[:] = pair_features[:, None, :]
+    if hour_col is not None:
+        features[:, :, hour_col] = np.arange(24)[None, :]
+
+    return features.reshape(n_pairs * 24, len(colnames))
+
+# Read a cached chunk (or just the pairs at positions rows within it) and build its features. Returns the origin and
+# destination GEOIDs of each pair, the features for each pair (see build_pair_features), and the index of the hour
+# column.
+def chunk_features (filename, rows=None):
+    # only read the along-route columns the model uses
+    chunk = pd.read_parquet(filename, columns=[col[len('along_route_'):] for col in colnames if col.startswith('along_route_')])
+    if rows is not None:
+        chunk = chunk.iloc[rows]
+    from_geoid = chunk.index.get_level_values('from_geoid')
+    to_geoid = chunk.index.get_level_values('to_geoid')
+
+    # integer positions of origins and destinations in the tract data and skims
+    from_pos = tract_positions.get_indexer(from_geoid)
+    to_pos = tract_positions.get_indexer(to_geoid)
+    assert (from_pos >= 0).all(), 'some from tracts not found'
+    assert (to_pos >= 0).all(), 'some to tracts not found'
+
+    from_skim = skims.positions(from_geoid)
+    to_skim = skims.positions(to_geoid)
+
+    return (from_geoid, to_geoid, *build_pair_features(chunk, from_pos, to_pos, from_skim, to_skim))
+
+# Actual worker function (called with a chunk of along_route.csv). Returns the origin and destination GEOIDs of each
+# pair, and the predictions as an array of pairs x hours.
+def worker (filename, rows=None):
+    from_geoid, to_geoid, pair_features, hour_col = chunk_features(filename, rows)
 
     # predict!
-    chunk['pred_congestion_ratio'] = rf.predict(est_data)
+    if forest is not None and hour_col is not None:
+        # fills in the hours inside the kernel, rather than building every pair's row 24 times here
+        pred = forest_inference.predict_hourly(forest, pair_features, hour_col, 24, predict_threads).ravel()
+    elif forest is not None:
+        pred = forest_inference.predict(forest, broadcast_hours(pair_features, hour_col), predict_threads)
+    else:
+        # wrapped in a DataFrame, without copying, since the model was fit with feature names
+        pred = rf.predict(pd.DataFrame(broadcast_hours(pair_features, hour_col), columns=colnames, copy=False))
+
+    return from_geoid, to_geoid, pred.reshape(len(from_geoid), 24)
+
+# worker for --delta, called with (filename, rows)
+def delta_worker (task):
+    return worker(*task)
+
+# Writes predictions to a Parquet file as they arrive, one row group per chunk, in the same format as writing one
+# DataFrame indexed by from_geoid, to_geoid and hour. Written under a temporary name and renamed on close, so an
+# interrupted run doesn't leave a partial file that looks complete.
+class ParquetPredictionWriter:
+    def __init__ (self, filename):
+        self.filename = filename
+        self.tmp = os.path.join(os.path.dirname(filename), f'.{os.path.basename(filename)}.tmp')
+        self.writer = None
+
+    def write (self, from_geoid, to_geoid, pred):
+        n_pairs = len(from_geoid)
+        chunk = pd.DataFrame({
+            'from_geoid': np.repeat(from_geoid, 24),
+            'to_geoid': np.repeat(to_geoid, 24),
+            'hour': np.tile(np.arange(24), n_pairs),
+            'congested_tt_ratio': pred.ravel()
+        }).set_index(['from_geoid', 'to_geoid', 'hour'])
+
+        if self.writer is None:
+            table = pa.Table.from_pandas(chunk)
+            self.writer = pq.ParquetWriter(self.tmp, table.schema)
+        else:
+            table = pa.Table.from_pandas(chunk, schema=self.writer.schema)
+        self.writer.write_table(table)
+
+    def close (self, complete=True):
+        if self.writer is not None:
+            self.writer.close()
+            if complete:
+                os.replace(self.tmp, self.filename)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, *exc):
+        self.close(exc_type is None)
+
+# Writes predictions into a memory-mapped .npy array of hour x origin x destination float32 values, with tracts in
+# the order of a sidecar table <name>_tracts.parquet (idx, geoid). Pairs that were never predicted are NaN. Only the
+# pages being written are held in memory, and results can be read back with np.load(filename, mmap_mode='r'). If base
+# is the filename of an earlier output for the same tracts, it is copied and predictions are written over it.
+class DensePredictionWriter:
+    def __init__ (self, filename, geoids, base=None):
+        self.filename = filename
+        self.tmp = os.path.join(os.path.dirname(filename), f'.{os.path.basename(filename)}.tmp')
+        self.positions = pd.Index(geoids)
+
+        if base is not None:
+            base_geoids = pd.read_parquet(congested_routes_mp.tract_table_filename(base)).sort_values('idx').geoid
+            assert base_geoids.tolist() == list(self.positions), f'tracts in {base} do not match the current tracts'
+            shutil.copyfile(base, self.tmp)
+            self.values = np.load(self.tmp, mmap_mode='r+')
+        else:
+            self.values = np.lib.format.open_memmap(self.tmp, mode='w+', dtype='float32', shape=(24, len(geoids), len(geoids)))
+            self.values[:] = np.nan
+
+        pq.write_table(pa.table({'idx': np.arange(len(geoids), dtype='int32'), 'geoid': np.asarray(geoids, dtype=str)}),
+            congested_routes_mp.tract_table_filename(filename))
+
+    def write (self, from_geoid, to_geoid, pred):
+        self.values[:, self.positions.get_indexer(from_geoid), self.positions.get_indexer(to_geoid)] = pred.T
+
+    def close (self, complete=True):
+        self.values.flush()
+        del self.values
+        if complete:
+            os.replace(self.tmp, self.filename)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, *exc):
+        self.close(exc_type is None)
+
+# Builds congested driving time skims for each ActivitySim time period as predictions arrive, rather than writing
+# hourly ratios and aggregating them afterwards. Each pair's ratios are averaged over the hours in the period and
+# multiplied by the free flow time, and matrices are written to an OMX file with the ActivitySim names used in
+# Assemble Skims.ipynb (SOV_TIME__AM, SOV_DIST__AM, etc.), in skim tract order.
+class PeriodSkimWriter:
+    def __init__ (self, filename):
+        self.filename = filename
+        self.tmp = os.path.join(os.path.dirname(filename), f'.{os.path.basename(filename)}.tmp')
+        self.skims = skim_access.Skims()
+        n_tracts = len(self.skims.geoids)
+        self.times = {period: np.full((n_tracts, n_tracts), np.nan, dtype='float32') for period in TIME_PERIODS}
+
+    def write (self, from_geoid, to_geoid, pred):
+        from_skim = self.skims.positions(from_geoid)
+        to_skim = self.skims.positions(to_geoid)
+        freeflow = self.skims.gather('car_freeflow', from_skim, to_skim)
+        for period, (start, end) in TIME_PERIODS.items():
+            # intentionally not including end, as it represents the hour after the time window is over
+            self.times[period][from_skim, to_skim] = freeflow * pred[:, start:end].mean(axis=1)
+
+    def close (self, complete=True):
+        if not complete:
+            return
+
+        freeflow = self.skims.matrix('car_freeflow')
+        for period, times in self.times.items():
+            assert not np.isnan(times).any(), f'some pairs not predicted in {period}'
+            n_faster = np.sum(times < freeflow)
+            if n_faster > 0:
+                print(f'warning: {n_faster:,d} pairs faster than free flow in {period}')
+
+        with omx.open_file(self.tmp, 'w') as out:
+            for period, times in self.times.items():
+                # free flow drive times already in minutes
+                out[f'SOV_TIME__{period}'] = times
+                out[f'SOV_DIST__{period}'] = np.asarray(self.skims.matrix('car_distance_km')) / 1.609  # miles
+        os.replace(self.tmp, self.filename)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, *exc):
+        self.close(exc_type is None)
+
+# a dense array if filename ends in .npy, time period skims if it ends in .omx, otherwise Parquet
+def open_prediction_writer (filename, geoids):
+    if filename.endswith('.npy'):
+        return DensePredictionWriter(filename, geoids)
+    elif filename.endswith('.omx'):
+        return PeriodSkimWriter(filename)
+    else:
+        return ParquetPredictionWriter(filename)
 
-    # return
-    return chunk.reset_index().set_index(['from_geoid', 'to_geoid', 'hour']).pred_congestion_ratio
+# Parquet files making up along_route (a directory written by congested_routes_mp.py, or a single file)
+def along_route_files (along_route_file=ALONG_ROUTE_FILE):
+    if os.path.isdir(along_route_file):
+        return sorted(glob(os.path.join(along_route_file, '*.parquet')))
+    else:
+        return [along_route_file]
+
+# size and modification time of each file making up along_route and its tract table, to tell quickly whether the inputs
+# might have changed
+def source_stats (along_route_file=ALONG_ROUTE_FILE):
+    stats = {}
+    for filename in [*along_route_files(along_route_file), congested_routes_mp.tract_table_filename(along_route_file)]:
+        stat = os.stat(filename)
+        stats[os.path.abspath(filename)] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+# Everything that determines which pairs are in which chunk and which columns each chunk has (the value columns and
+# bands of along_route, if given): if any of this changes, no cached chunk can be reused
+def cache_settings (geoids, value_cols=None, bands=None):
+    settings = {
+        'version': CACHE_VERSION,
+        'chunk_size': CHUNK_SIZE,
+        'geoids_sha256': tract_data.geoid_hash(geoids)
+    }
+    if value_cols is not None:
+        settings['value_cols'] = list(value_cols)
+        settings['bands'] = list(bands)
+    return settings
+
+# The value columns and distance band labels in along_route (in order of distance), reading only the band column
+def along_route_layout (along_route_file=ALONG_ROUTE_FILE):
+    files = along_route_files(along_route_file)
+    value_cols = [col for col in pq.read_schema(files[0]).names if col not in ('fromidx', 'toidx', 'band')]
+    bands = set()
+    for filename in files:
+        bands.update(pq.read_table(filename, columns=['band']).column('band').unique().to_pylist())
+    return value_cols, sorted(bands, key=congested_routes_mp.parse_band_label)
+
+# Name of the feature for value column col in the band with label, as used by the model, e.g. pop_dens_sqkm_50_2_4
+# for the median population density in (2, 4]
+def band_feature_name (col, label):
+    low, high = congested_routes_mp.parse_band_label(label)
+    return f'{col}_{low:g}_{high:g}'
+
+# Stream along_route in batches of at most BATCH_ROWS rows, yielding (batch, origin positions, destination positions),
+# with origins and destinations as positions in geoids and each row's band as an index into bands. Rows for tracts not
+# in geoids are dropped (as they would be when reindexing to all pairs of geoids).
+def along_route_batches (geoids, bands, along_route_file=ALONG_ROUTE_FILE):
+    # tracts are stored as integer indexes, look up positions once per tract rather than once per row
+    along_route_tracts = pd.read_parquet(congested_routes_mp.tract_table_filename(along_route_file))
+    tract_pos = np.full(along_route_tracts.idx.max() + 1, -1, dtype='int64')
+    tract_pos[along_route_tracts.idx.to_numpy()] = pd.Index(geoids).get_indexer(along_route_tracts.geoid)
+
+    for filename in along_route_files(along_route_file):
+        for batch in pq.ParquetFile(filename).iter_batches(BATCH_ROWS):
+            batch = batch.to_pandas()
+            from_pos = tract_pos[batch.fromidx.to_numpy()]
+            to_pos = tract_pos[batch.toidx.to_numpy()]
+            keep = (from_pos >= 0) & (to_pos >= 0)
+
+            # band labels are dictionary-encoded, so only look up each distinct label
+            band = pd.Categorical(batch.band)
+            batch = batch.drop(columns=['fromidx', 'toidx'])
+            batch['band'] = pd.Index(bands).get_indexer(band.categories.astype(str))[band.codes]
+            yield batch[keep], from_pos[keep], to_pos[keep]
+
+# A hash of the source rows that go into each chunk, so chunks can be rebuilt only if their rows changed. Each row is
+# hashed with the pair it ends up at (it's used once in each direction), and the hashes of the rows in a chunk are
+# summed, so the result doesn't depend on the order of the rows.
+def chunk_hashes (geoids, bands, along_route_file=ALONG_ROUTE_FILE):
+    n_tracts = len(geoids)
+    n_chunks = -(-n_tracts * n_tracts // CHUNK_SIZE)
+    hashes = np.zeros(n_chunks, dtype='uint64')
+
+    for batch, from_pos, to_pos in along_route_batches(geoids, bands, along_route_file):
+        row_hash = pd.util.hash_pandas_object(batch, index=False).to_numpy()
+        from_pos = from_pos.astype('uint64')
+        to_pos = to_pos.astype('uint64')
+        for pair in (from_pos * np.uint64(n_tracts) + to_pos, to_pos * np.uint64(n_tracts) + from_pos):
+            np.add.at(hashes, (pair // np.uint64(CHUNK_SIZE)).astype('int64'), pd.util.hash_array(pair) ^ row_hash)
+
+    return [f'{h:016x}' for h in hashes]
+
+# position of the pair of tracts i < j in a packed upper triangle of an n x n matrix (without the diagonal)
+def upper_triangle_index (i, j, n):
+    return i * (2 * n - i - 1) // 2 + (j - i - 1)
+
+# Reshape along_route into one row per tract pair (in both directions) and one column per value and band, for just
+# the given chunks of the full list of pairs in geoids order. Yields (chunk number, DataFrame) for each chunk.
+#
+# This is done out of core. along_route is streamed in batches, and the rows used by the chunks are written into a
+# memory-mapped file in cache_dir with the values of each pair, stored once for both directions, so only the batch
+# and the chunk being written are ever held in memory. Pairs with no tracts along the route (or no tracts in some band)
+# are never written, and are filled with -1 when the chunk is read out.
+def reshape_chunks (geoids, chunks, value_cols, bands, along_route_file=ALONG_ROUTE_FILE, cache_dir=CACHE_DIR):
+    n_tracts = len(geoids)
+    n_upper = n_tracts * (n_tracts - 1) // 2
+    is_needed = np.zeros(-(-n_tracts * n_tracts // CHUNK_SIZE), dtype=bool)
+    is_needed[chunks] = True
+
+    # files are created sparse, so only the parts for the chunks being rebuilt take space on disk
+    values_file = os.path.join(cache_dir, f'.pair_values.{os.getpid()}.npy')
+    present_file = os.path.join(cache_dir, f'.pair_present.{os.getpid()}.npy')
+    values = np.lib.format.open_memmap(values_file, mode='w+', dtype='float32', shape=(n_upper, len(value_cols), len(bands)))
+    present = np.lib.format.open_memmap(present_file, mode='w+', dtype=bool, shape=(n_upper, len(bands)))
+
+    try:
+        for batch, from_pos, to_pos in along_route_batches(geoids, bands, along_route_file):
+            # only the rows used in these chunks
+            needed = is_needed[(from_pos * n_tracts + to_pos) // CHUNK_SIZE] | is_needed[(to_pos * n_tracts + from_pos) // CHUNK_SIZE]
+            i = np.minimum(from_pos, to_pos)[needed]
+            j = np.maximum(from_pos, to_pos)[needed]
+            band = batch.band.to_numpy()[needed]
+            pair = upper_triangle_index(i, j, n_tracts)
+
+            values[pair, :, band] = batch[value_cols].to_numpy()[needed]
+            present[pair, band] = True
+
+        columns = [band_feature_name(col, band) for col in value_cols for band in bands]
+
+        for chunk in chunks:
+            # the pair from -> to has the same values as to -> from
+            pairs = np.arange(chunk * CHUNK_SIZE, min((chunk + 1) * CHUNK_SIZE, n_tracts * n_tracts))
+            from_pos = pairs // n_tracts
+            to_pos = pairs % n_tracts
+            off_diagonal = from_pos != to_pos
+            pair = upper_triangle_index(np.minimum(from_pos, to_pos), np.maximum(from_pos, to_pos), n_tracts)[off_diagonal]
+
+            chunk_values = np.full((len(pairs), len(value_cols), len(bands)), -1, dtype='float32')
+            chunk_values[off_diagonal] = np.where(present[pair][:, None, :], values[pair], -1)
+            # fill expected nulls (okay for some bands to be null, no tracts in band)
+            chunk_values[np.isnan(chunk_values)] = -1
+
+            index = pd.MultiIndex.from_arrays([geoids[from_pos], geoids[to_pos]], names=['from_geoid', 'to_geoid'])
+            yield chunk, pd.DataFrame(chunk_values.reshape(len(pairs), -1), index=index, columns=columns)
+
+    finally:
+        del values, present
+        os.remove(values_file)
+        os.remove(present_file)
+
+def write_manifest (manifest, cache_dir=CACHE_DIR):
+    file_cache.save_json(os.path.join(cache_dir, 'manifest.json'), manifest)
+
+# Make sure the reshaped chunks in cache_dir are current for along_route and the tracts in geoids, rebuilding only
+# chunks whose source rows changed, and return the chunk filenames. The cache manifest records the settings the
+# chunks were built with, the stats of the source files, and a hash of the source rows of each chunk.
+def update_chunk_cache (geoids, along_route_file=ALONG_ROUTE_FILE, cache_dir=CACHE_DIR):
+    geoids = np.asarray(geoids, dtype=str)
+    settings = cache_settings(geoids)
+    sources = source_stats(along_route_file)
+    n_chunks = -(-len(geoids) * len(geoids) // CHUNK_SIZE)
+    files = [os.path.join(cache_dir, f'chunk_{i}.parquet') for i in range(n_chunks)]
+
+    manifest = None
+    manifest_file = os.path.join(cache_dir, 'manifest.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    # if the source files are unchanged, so are their columns and bands, which take a pass over along_route to find
+    if manifest is not None and manifest['sources'] == sources and \
+            all(manifest['settings'].get(key) == value for key, value in settings.items()) and \
+            all(h is not None for h in manifest['chunks']) and all(os.path.exists(f) for f in files):
+        print('using cached inputs')
+        return files
+
+    print('reading inputs')
+    os.makedirs(cache_dir, exist_ok=True)
+    value_cols, bands = along_route_layout(along_route_file)
+    settings = cache_settings(geoids, value_cols, bands)
+    if manifest is not None and manifest['settings'] != settings:
+        print('chunk layout or columns changed, rebuilding all cached inputs')
+        manifest = None
+
+    hashes = chunk_hashes(geoids, bands, along_route_file)
+
+    old_hashes = manifest['chunks'] if manifest is not None else [None] * n_chunks
+    stale = [i for i in range(n_chunks) if hashes[i] != old_hashes[i] or not os.path.exists(files[i])]
+
+    # chunks about to be rewritten are marked invalid first, so an interrupted rebuild is never mistaken for current
+    for i in stale:
+        old_hashes[i] = None
+    write_manifest({'settings': settings, 'sources': None, 'chunks': old_hashes}, cache_dir)
+
+    if len(stale) > 0:
+        print(f'reshaping {len(stale):,d} of {n_chunks:,d} chunks')
+        for i, chunk in tqdm.tqdm(reshape_chunks(geoids, stale, value_cols, bands, along_route_file, cache_dir), total=len(stale)):
+            tmp = os.path.join(cache_dir, f'.chunk_{i}.parquet.tmp')
+            chunk.to_parquet(tmp)
+            os.replace(tmp, files[i])
+    else:
+        print('source files changed, but no cached chunks are affected')
+
+    # chunks beyond the end, if there are now fewer pairs
+    for filename in glob(os.path.join(cache_dir, 'chunk_*.parquet')):
+        if int(os.path.basename(filename)[len('chunk_'):-len('.parquet')]) >= n_chunks:
+            os.remove(filename)
+
+    write_manifest({'settings': settings, 'sources': sources, 'chunks': hashes}, cache_dir)
+    return files
+
+# Start a cache for a scenario's along_route from the cache for the base along_route, so that only chunks whose rows
+# differ are rebuilt. Chunk files are hard-linked rather than copied; this is safe because rebuilt chunks are written
+# to a new file and renamed over the old name, so the base cache is never modified.
+def seed_scenario_cache (base_dir, scenario_dir):
+    if os.path.exists(os.path.join(scenario_dir, 'manifest.json')):
+        return
+
+    os.makedirs(scenario_dir, exist_ok=True)
+    for filename in glob(os.path.join(base_dir, 'chunk_*.parquet')):
+        target = os.path.join(scenario_dir, os.path.basename(filename))
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(filename, target)
+        except OSError:
+            # e.g. different file systems
+            shutil.copyfile(filename, target)
+
+    with open(os.path.join(base_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    # source files are different, so chunks will be checked against the scenario's rows
+    manifest['sources'] = None
+    write_manifest(manifest, scenario_dir)
+
+# Tracts (as a boolean array by position) whose densities in the scenario (arrays by column, from cached_densities)
+# differ from the tract data, after the same fix for tracts with no land area that the workers apply. Densities are
+# compared as float32, as they are in the model's features, so tiny differences from e.g. a round trip through CSV
+# don't count as changes.
+def changed_tracts (tract_centroids, densities):
+    no_land = tract_centroids.aland.to_numpy() < 1e-5
+    changed = np.zeros(len(tract_centroids), dtype=bool)
+    for col, new in densities.items():
+        changed |= np.where(no_land, 0, new).astype('float32') != tract_centroids[col].to_numpy().astype('float32')
+    return changed
+
+# Pairs that need to be predicted again for a scenario, as a list of (scenario chunk filename, rows within the chunk).
+# A pair is included if the densities of its origin or destination changed, or if its along-route features changed.
+# Along-route features are only compared for chunks whose source rows hash differently in the two caches.
+def delta_tasks (geoids, tract_changed, base_dir, scenario_dir):
+    n_tracts = len(geoids)
+    with open(os.path.join(base_dir, 'manifest.json')) as f:
+        base_manifest = json.load(f)
+    with open(os.path.join(scenario_dir, 'manifest.json')) as f:
+        scenario_manifest = json.load(f)
+    # chunks can only be compared column by column if they have the same columns
+    assert base_manifest['settings'] == scenario_manifest['settings'], \
+        'base and scenario along-route features have different columns or bands, run the scenario in full instead of with --delta'
+    base_hashes = base_manifest['chunks']
+    scenario_hashes = scenario_manifest['chunks']
+
+    tasks = []
+    for i, (base_hash, scenario_hash) in enumerate(zip(tqdm.tqdm(base_hashes), scenario_hashes)):
+        pairs = np.arange(i * CHUNK_SIZE, min((i + 1) * CHUNK_SIZE, n_tracts * n_tracts))
+        changed = tract_changed[pairs // n_tracts] | tract_changed[pairs % n_tracts]
+
+        if base_hash != scenario_hash:
+            base_values = pd.read_parquet(os.path.join(base_dir, f'chunk_{i}.parquet')).to_numpy()
+            scenario_values = pd.read_parquet(os.path.join(scenario_dir, f'chunk_{i}.parquet')).to_numpy()
+            changed |= (base_values != scenario_values).any(axis=1)
+
+        if changed.any():
+            tasks.append((os.path.join(scenario_dir, f'chunk_{i}.parquet'), np.flatnonzero(changed)))
+
+    return tasks
+
+# Memory available to new processes, in bytes
+def available_memory ():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+# Number of worker processes that fit in memory_budget bytes (at most one per core). Memory-mapped data (the forest,
+# skims and tract data) is shared between workers, so it is only counted once; each worker also needs its own memory
+# for libraries, the features and predictions of a chunk, and its own model if not using the compiled forest.
+def choose_processes (memory_budget, shared_bytes, n_features):
+    if USE_COMPILED_FOREST:
+        chunk_bytes = CHUNK_SIZE * (n_features * 4 + 24 * 8)
+    else:
+        chunk_bytes = CHUNK_SIZE * 24 * n_features * 4 * 2 + os.path.getsize(MODEL_FILE) * 2
+    # several copies of a chunk are around at once (parquet buffers, DataFrame, features, predictions)
+    worker_bytes = WORKER_BASE_MEMORY + chunk_bytes * 4
+    return max(1, min(multiprocessing.cpu_count(), int((memory_budget - shared_bytes) // worker_bytes)))
 
 if __name__ == '__main__':
-    tract_centroids = gp.read_file('tract_centroids_density.json')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='predicted_congestion_ratio.parquet',
+        help='output Parquet file, a dense hour x origin x destination array if the name ends in .npy, or congested time period skims for ActivitySim if it ends in .omx')
+    parser.add_argument('--processes', type=int, default=None,
+        help='number of worker processes (default: as many as fit in --memory-budget, up to one per core). With 1, predictions run in the main process using all cores')
+    parser.add_argument('--memory-budget', type=float, default=None,
+        help='memory available for prediction in GB (default: 80%% of currently available memory)')
+    parser.add_argument('--along-route', default=ALONG_ROUTE_FILE,
+        help='along-route features from congested_routes_mp.py (for --delta, those for the scenario, from --reaggregate)')
+    parser.add_argument('--delta', default=None, metavar='DENSITIES',
+        help='predict a land use scenario with the tract densities in this file (GeoJSON, CSV, or Parquet), only predicting pairs that differ from --base-prediction')
+    parser.add_argument('--base-prediction', default=None,
+        help='with --delta, the .npy output of a full run for the base land use, which is copied to --output and updated')
+    parser.add_argument('--base-along-route', default=ALONG_ROUTE_FILE,
+        help='with --delta, along-route features for the base land use')
+    parser.add_argument('--scenario-cache', default=CACHE_DIR + '_scenario',
+        help='with --delta, directory to cache reshaped along-route features for the scenario')
+    args = parser.parse_args()
+
+    # parsed at most once (and not at all if the cache is current), workers memory-map the cached columns (and fix
+    # densities themselves)
+    tract_centroids = tract_data.load_tract_centroids()
     # divide by zero issues
     tract_centroids.loc[tract_centroids.aland < 1e-5, ['pop_dens_sqkm', 'job_dens_sqkm']] = 0
 
-    if os.path.exists('congestion_cache/complete.mark'):
-       print('using cached inputs')
-    else: 
-        if not os.path.exists('congestion_cache'):
-            os.mkdir('congestion_cache')
-
-        print('reading and reshaping inputs')
+    geoids = tract_centroids.GEOID.to_numpy()
 
-        # use dask for the reshaping bit to save memory
-        along_route = pd.read_csv('../data/along_route.csv', dtype={'from_geoid': str, 'to_geoid': str})
-        along_route_back = along_route.rename(columns={'from_geoid': 'to_geoid', 'to_geoid': 'from_geoid'})
-        along_route = pd.concat([along_route, along_route_back], ignore_index=True)
-        del along_route_back
+    if args.delta is not None:
+        assert args.base_prediction is not None and args.base_prediction.endswith('.npy') and args.output.endswith('.npy'), \
+            '--delta requires a .npy --base-prediction and --output'
 
-        along_route = along_route.set_index(['from_geoid', 'to_geoid', 'band']).unstack().fillna(-1)
-        along_route.columns = [f'{col}_{band[1]}_{band[4]}' for col, band in along_route.columns]
+        update_chunk_cache(geoids, args.base_along_route, CACHE_DIR)
+        seed_scenario_cache(CACHE_DIR, args.scenario_cache)
+        update_chunk_cache(geoids, args.along_route, args.scenario_cache)
 
-        # make sure every tract pair is included even if there were no tracts on the way
-        along_route = along_route.reindex(list(product(tract_centroids.GEOID, tract_centroids.GEOID)), fill_value=-1)
-
-        print('caching reshaped inputs')
-        for i, chunk_start in enumerate(tqdm.trange(0, len(along_route), CHUNK_SIZE)):
-            chunk_end = min(chunk_start + CHUNK_SIZE, len(along_route))
-            along_route.iloc[chunk_start:chunk_end].to_parquet(f'congestion_cache/chunk_{i}.parquet')
-        
-        with open('congestion_cache/complete.mark', 'w') as markfile:
-            markfile.write('Generation completed: ' + datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))        
-        
-    results = []
-
-    # generator expression, don't materialize all at once
-    files = glob('congestion_cache/chunk_*.parquet')
-
-    if MULTIPROCESS:
-        pool = multiprocessing.Pool(multiprocessing.cpu_count(), initializer=initialize_worker)
+        # read once here, and memory-mapped by the workers
+        tract_changed = changed_tracts(tract_centroids, cached_densities(args.delta, geoids))
+        print(f'{np.sum(tract_changed):,d} tracts have different densities, finding pairs to predict')
+        tasks = delta_tasks(geoids, tract_changed, CACHE_DIR, args.scenario_cache)
+        print(f'predicting {sum(len(rows) for filename, rows in tasks):,d} of {len(geoids) ** 2:,d} pairs')
+        task_worker = delta_worker
+    else:
+        # only chunks whose inputs changed are rebuilt
+        tasks = update_chunk_cache(geoids, args.along_route)
+        task_worker = worker
+
+    # build the caches shared by the workers before starting them, so they aren't all building them at once
+    forest, colnames = cached_forest() if USE_COMPILED_FOREST else (None, joblib.load(MODEL_FILE)[1])
+    skims = skim_access.Skims()
+    shared_bytes = sum(skims.matrix(name).nbytes for name in ('car_freeflow', 'car_distance_km'))
+    if forest is not None:
+        shared_bytes += sum(values.nbytes for values in forest.values())
+    del forest, skims
+
+    if args.processes is not None:
+        n_processes = args.processes
+    else:
+        memory_budget = args.memory_budget * 2 ** 30 if args.memory_budget is not None else available_memory() * 0.8
+        n_processes = choose_processes(memory_budget, shared_bytes, len(colnames))
 
-        total_length = int(len(tract_centroids) * len(tract_centroids))
+    if n_processes > 1:
+        pool = multiprocessing.Pool(n_processes, initializer=initialize_worker, initargs=(tract_data.TRACT_CACHE, 1,
+            DENSITY_CACHE if args.delta is not None else None))
 
-        print(f'Parallelizing {total_length:,d} tasks over {multiprocessing.cpu_count()} processes in chunks of {CHUNK_SIZE}')
+        print(f'Parallelizing {len(tasks):,d} chunks of up to {CHUNK_SIZE} tract pairs over {n_processes} processes')
 
-        iterable = pool.imap_unordered(worker, files)
+        iterable = pool.imap_unordered(task_worker, tasks)
     else:
-        print('Parallelization not requested')
-        initialize_worker()  # load needed globals in main process
-        iterable = map(worker, files)
-
-    for result in tqdm.tqdm(iterable, total=len(files)):
-        results.append(result)
+        print('Predicting in the main process')
+        initialize_worker(density_dir=DENSITY_CACHE if args.delta is not None else None)  # load needed globals in main process
+        iterable = map(task_worker, tasks)
 
-    if not MULTIPROCESS:
-        # free RAM
-        del tract_centroids, rf, car_tt, netdist, colnames
+    # results are written as each chunk finishes, rather than concatenated at the end
+    if args.delta is not None:
+        writer = DensePredictionWriter(args.output, geoids, base=args.base_prediction)
+    else:
+        writer = open_prediction_writer(args.output, geoids)
 
-    final_result = pd.DataFrame({'congested_tt_ratio': pd.concat(results)})
-    final_result.to_parquet('predicted_congestion_ratio.parquet')
+    with writer:
+        for from_geoid, to_geoid, pred in tqdm.tqdm(iterable, total=len(tasks)):
+            writer.write(from_geoid, to_geoid, pred)
 
 
 
@@ -0,0 +1,79 @@
+# Caches of data derived from an input file, such as the parsed tract GeoJSON (tract_data.py), matrices converted
+# from the OMX skims (skim_access.py) and the exported random forest (congestion_prediction_mp.py). Each cache has a
+# stamp file recording which version of the input it was built from, and is rebuilt when the input changes.
+#
+# Cache files are written under a temporary name and renamed, so several processes using a cache at once (e.g.
+# workers, or shards started together) never see a partly-written file.
+
+import numpy as np
+import hashlib
+import json
+import os
+import socket
+
+# Call write with a temporary filename in the same directory as filename (with the same extension), then rename the
+# temporary file to filename. The temporary name includes the host as well as the process, since processes on
+# different nodes may write to the same shared directory.
+def write_atomic (filename, write):
+    directory, basename = os.path.split(filename)
+    tmp = os.path.join(directory, f'.{socket.gethostname()}.{os.getpid()}.{basename}')
+    write(tmp)
+    os.replace(tmp, filename)
+
+def save_npy (filename, values):
+    write_atomic(filename, lambda tmp: np.save(tmp, values))
+
+def save_text (filename, text):
+    def write (tmp):
+        with open(tmp, 'w') as f:
+            f.write(text)
+    write_atomic(filename, write)
+
+def save_json (filename, value):
+    save_text(filename, json.dumps(value))
+
+def load_json (filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+def file_hash (filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Make sure the cache stamped by stamp_file was built from the current version of source_file, calling build() to
+# rebuild it if not. build may return a dict of information to keep in the stamp (e.g. column names). Returns the
+# stamp. The cache is current if the path, size and modification time of source_file match the stamp, or, with
+# check_hash, if its contents hash the same (e.g. after a copy that didn't preserve mtime). settings is a dict of
+# anything else the cache depends on (e.g. a format version), which must also match.
+def update_cache (source_file, stamp_file, build, check_hash=False, settings=None):
+    stat = os.stat(source_file)
+    source = {'filename': os.path.abspath(source_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+        **(settings or {})}
+    cached = load_json(stamp_file)
+
+    if cached is not None and all(cached.get(k) == v for k, v in source.items()):
+        return cached
+
+    current = False
+    if check_hash:
+        source['sha256'] = file_hash(source_file)
+        current = cached is not None and all(cached.get(k) == v for k, v in source.items() if k not in ('size', 'mtime_ns'))
+
+    if current:
+        stamp = {**cached, **source}
+    else:
+        os.makedirs(os.path.dirname(stamp_file) or '.', exist_ok=True)
+        # remove the stamp first, so an interrupted rebuild is not mistaken for a valid cache
+        try:
+            os.remove(stamp_file)
+        except FileNotFoundError:
+            pass
+        stamp = {**source, **(build() or {})}
+
+    save_json(stamp_file, stamp)
+    return stamp
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+# Fast prediction for the scikit-learn random forest used in the congestion model. The forest is exported to a flat
+# array of node records (split feature, threshold and children for every node of every tree) and an array of node
+# values, and a numba kernel walks all the trees for blocks of rows in parallel threads (see NODE_DTYPE and BLOCK_ROWS).
+#
+# congestion_prediction_mp.py predicts every tract pair for all 24 hours, and the rows for a pair differ only in the
+# hour. predict_hourly takes one row per pair and fills in the hours a block at a time inside the kernel, so the rows
+# for every hour are never all in memory at once.
+#
+# Run directly to check that predictions match rf.predict and compare throughput, using feature rows built from the
+# cached chunks in congestion_cache (so run congestion_prediction_mp.py first).
+
+import numpy as np
+import numba
+import argparse
+import time
+import os
+import file_cache
+
+# One record per node, so walking a tree touches one cache line per node rather than one in each of several arrays.
+# Each tree's nodes are numbered breadth-first, so the children of a node are always left and left + 1, and a walk can
+# step to left + (x > threshold) without a branch. Leaves point back to themselves with an infinite threshold, so walking
+# on from a leaf stays there. Thresholds are float32, rounded down from sklearn's float64 thresholds, so that comparing a
+# float32 feature value with them gives exactly the same result as sklearn's comparison with the float64 threshold.
+# Indices are unsigned so numba doesn't check them for negative (from the end) indexing at every step.
+NODE_DTYPE = np.dtype([('feature', 'uint32'), ('threshold', 'float32'), ('left', 'uint32')])
+
+# changes whenever the exported format changes, so cached exports are rebuilt
+FOREST_FORMAT = 3
+
+# Rows are predicted in blocks of this many. All the rows in a block walk a tree together, one level at a time down to
+# the tree's depth (rows that reach a leaf early just stay there), before moving on to the next tree. The steps for
+# different rows don't depend on each other, so the processor overlaps them rather than waiting on each node load and
+# mispredicted branch in turn, and the top levels of the tree stay in cache for all the rows in the block.
+BLOCK_ROWS = 256
+
+# Export a fitted RandomForestRegressor (or any ensemble of single-output sklearn regression trees that are averaged)
+# to a dict of flat arrays: nodes (NODE_DTYPE records, with child indices global across trees), the value of every
+# node (the leaf values, and for other nodes the mean of the training samples below them, see truncate_forest), the
+# root node of each tree and the depth of each tree.
+def export_forest (rf):
+    nodes = []
+    values = []
+    roots = []
+    depths = []
+    n_nodes = 0
+
+    for est in rf.estimators_:
+        tree = est.tree_
+        if tree.n_outputs != 1 or tree.value.shape[2] != 1:
+            raise ValueError('only single-output regression forests are supported')
+
+        order, depth = breadth_first(tree.children_left, tree.children_right)
+        # position of each sklearn node in the breadth-first order
+        position = np.empty(tree.node_count, dtype='int64')
+        position[order] = np.arange(tree.node_count)
+
+        left = tree.children_left[order]
+        is_leaf = left == -1
+        tree_nodes = np.empty(tree.node_count, dtype=NODE_DTYPE)
+        tree_nodes['feature'] = np.where(is_leaf, 0, tree.feature[order])
+        tree_nodes['threshold'] = np.where(is_leaf, np.float32(np.inf), float32_at_most(tree.threshold[order]))
+        tree_nodes['left'] = np.where(is_leaf, np.arange(tree.node_count), position[left]) + n_nodes
+
+        roots.append(n_nodes)
+        depths.append(depth.max())
+        nodes.append(tree_nodes)
+        values.append(tree.value[order, 0, 0])
+        n_nodes += tree.node_count
+
+    if n_nodes >= 2 ** 32:
+        raise ValueError('forest has too many nodes')
+
+    return {
+        'nodes': np.concatenate(nodes),
+        'value': np.concatenate(values).astype('float64'),
+        'roots': np.array(roots, dtype='uint32'),
+        'depths': np.array(depths, dtype='int32')
+    }
+
+# The nodes of an sklearn tree (given as its children_left and children_right arrays) in breadth-first order, with right
+# children straight after left children, and the depth of each node in that order
+def breadth_first (children_left, children_right):
+    order = [np.array([0])]
+    while True:
+        parents = order[-1][children_left[order[-1]] != -1]
+        if len(parents) == 0:
+            break
+        order.append(np.stack([children_left[parents], children_right[parents]], axis=1).ravel())
+    depth = np.repeat(np.arange(len(order)), [len(level) for level in order])
+    return np.concatenate(order), depth
+
+# the largest float32 values that are no greater than each of the float64 values in x
+def float32_at_most (x):
+    x32 = x.astype('float32')
+    above = x32.astype('float64') > x
+    x32[above] = np.nextafter(x32[above], np.float32(-np.inf))
+    return x32
+
+# Depth of every node in an exported forest (roots are at depth 0, nodes not in any tree are -1)
+def node_depths (forest):
+    left = forest['nodes']['left'].astype('int64')
+    depth = np.full(len(left), -1, dtype='int32')
+    nodes = forest['roots'].astype('int64')
+    level = 0
+    while len(nodes) > 0:
+        depth[nodes] = level
+        nodes = nodes[left[nodes] != nodes]
+        nodes = np.concatenate([left[nodes], left[nodes] + 1])
+        level += 1
+    return depth
+
+# A smaller version of an exported forest, to trade accuracy for speed: only the first n_trees trees, and/or each tree
+# cut off at max_depth, with nodes at that depth becoming leaves. sklearn stores the mean of the training samples at
+# every node, not just leaves, so a cut-off node predicts the mean of the leaves below it (weighted by samples).
+def truncate_forest (forest, n_trees=None, max_depth=None):
+    truncated = {name: values.copy() for name, values in forest.items()}
+    if n_trees is not None:
+        truncated['roots'] = truncated['roots'][:n_trees]
+        truncated['depths'] = truncated['depths'][:n_trees]
+    if max_depth is not None:
+        cut = np.flatnonzero(node_depths(truncated) == max_depth)
+        truncated['nodes']['left'][cut] = cut
+        truncated['nodes']['threshold'][cut] = np.inf
+        truncated['nodes']['feature'][cut] = 0
+        truncated['depths'] = np.minimum(truncated['depths'], max_depth)
+    return truncated
+
+# Save an exported forest as one .npy file per array in directory
+def save_forest (forest, directory):
+    os.makedirs(directory, exist_ok=True)
+    for name, values in forest.items():
+        file_cache.save_npy(os.path.join(directory, f'{name}.npy'), values)
+
+# Memory-map a forest saved with save_forest, so that processes using the same forest share one copy of it through
+# the operating system's page cache
+def load_forest (directory):
+    # plain arrays backed by the mapping, so the kernels aren't compiled again for np.memmap arguments
+    return {name: np.asarray(np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r'))
+        for name in ('nodes', 'value', 'roots', 'depths')}
+
+# Walk every tree for rows start ... end - 1 of X together (see BLOCK_ROWS), adding the value of the leaf each row
+# reaches to out. node is scratch space for at least end - start node indices.
+@numba.jit(nopython=True, nogil=True)
+def _walk_block (X, start, end, nodes, value, roots, depths, node, out):
+    for t in range(len(roots)):
+        root = np.uint64(roots[t])
+        for i in range(end - start):
+            node[i] = root
+        for level in range(depths[t]):
+            for i in range(end - start):
+                record = nodes[node[i]]
+                # same comparison as sklearn (x <= threshold goes left), see NODE_DTYPE
+                node[i] = np.uint64(record.left) + np.uint64(X[start + i, np.uint64(record.feature)] > record.threshold)
+        for i in range(end - start):
+            out[start + i] += value[node[i]]
+
+@numba.jit(nopython=True, parallel=True, nogil=True)
+def _predict (X, nodes, value, roots, depths, block_rows):
+    out = np.zeros(X.shape[0])
+    n_blocks = (X.shape[0] + block_rows - 1) // block_rows
+    for block in numba.prange(n_blocks):
+        start = block * block_rows
+        end = min(start + block_rows, X.shape[0])
+        node = np.empty(block_rows, dtype=np.uint64)
+        _walk_block(X, start, end, nodes, value, roots, depths, node, out)
+        for i in range(start, end):
+            out[i] /= len(roots)
+    return out
+
+@numba.jit(nopython=True, parallel=True, nogil=True)
+def _predict_hourly (X, hour_col, n_hours, nodes, value, roots, depths, block_rows):
+    out = np.zeros((X.shape[0], n_hours))
+    block_pairs = max(1, block_rows // n_hours)
+    n_blocks = (X.shape[0] + block_pairs - 1) // block_pairs
+    for block in numba.prange(n_blocks):
+        start = block * block_pairs
+        end = min(start + block_pairs, X.shape[0])
+
+        # one row per pair and hour, built here rather than in the caller so all 24 copies never exist at once
+        rows = np.empty(((end - start) * n_hours, X.shape[1]), dtype=X.dtype)
+        for i in range(start, end):
+            for hour in range(n_hours):
+                rows[(i - start) * n_hours + hour] = X[i]
+                rows[(i - start) * n_hours + hour, hour_col] = hour
+
+        node = np.empty(len(rows), dtype=np.uint64)
+        block_out = np.zeros(len(rows))
+        _walk_block(rows, 0, len(rows), nodes, value, roots, depths, node, block_out)
+        for i in range(start, end):
+            for hour in range(n_hours):
+                out[i, hour] = block_out[(i - start) * n_hours + hour] / len(roots)
+    return out
+
+# Predict for X (rows x features, in the order the forest was fit with) using an exported forest. n_threads defaults to
+# all cores; use 1 inside multiprocessing workers.
+def predict (forest, X, n_threads=None):
+    X = np.ascontiguousarray(X, dtype='float32')
+    if n_threads is not None:
+        numba.set_num_threads(n_threads)
+    return _predict(X, forest['nodes'], forest['value'], forest['roots'], forest['depths'], BLOCK_ROWS)
+
+# Predict for X with one row per tract pair, for each hour 0 ... n_hours - 1 in column hour_col (the value already in
+# that column is ignored). Returns an array of pairs x hours, with the same values predict would give for each pair
+# and hour.
+def predict_hourly (forest, X, hour_col, n_hours=24, n_threads=None):
+    X = np.ascontiguousarray(X, dtype='float32')
+    if n_threads is not None:
+        numba.set_num_threads(n_threads)
+    return _predict_hourly(X, hour_col, n_hours, forest['nodes'], forest['value'], forest['roots'], forest['depths'],
+        BLOCK_ROWS)
+
+# A forest fit like the congestion model (see Congestion model.ipynb) to n_rows random feature rows roughly shaped like
+# the real ones (39 features, hour in column 0 and travel times that depend on it), for tests and benchmarks without
+# the model file. Returns the forest, the feature rows and the hour column.
+def synthetic_forest (n_rows, n_trees=100, min_samples_split=100, seed=0):
+    import sklearn.ensemble
+    rng = np.random.default_rng(seed)
+    X = rng.lognormal(7, 1.5, (n_rows, 39)).astype('float32')
+    X[:, 0] = rng.integers(0, 24, n_rows)
+    X[:, 1] = rng.uniform(1, 80, n_rows)
+    X[:, 2] = X[:, 1] * rng.uniform(0.8, 1.5, n_rows)
+    y = (1 + 0.3 * np.exp(-(X[:, 0] - 8) ** 2 / 4) + 0.4 * np.exp(-(X[:, 0] - 17) ** 2 / 6)
+        + 0.01 * np.log(X[:, 3:8]).sum(axis=1) + rng.normal(0, 0.1, n_rows))
+    rf = sklearn.ensemble.RandomForestRegressor(n_estimators=n_trees, min_samples_split=min_samples_split,
+        random_state=seed, n_jobs=-1).fit(X, y)
+    rf.n_jobs = None
+    return rf, X, 0
+
+# the shortest of several runs of func, in seconds
+def best_time (func, repeats=3):
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed)
+
+if __name__ == '__main__':
+    import pandas as pd
+    import joblib
+    from glob import glob
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=10, help='number of cached chunks to build feature rows from')
+    parser.add_argument('--synthetic', type=int, metavar='ROWS', help='instead of the model and cached chunks, '
+        'benchmark a forest fit like the model to this many random rows (100,000 gives a forest of realistic size)')
+    parser.add_argument('--pairs', type=int, default=4000, help='number of pairs to predict with --synthetic')
+    parser.add_argument('--threads', default=str(numba.config.NUMBA_NUM_THREADS), help='comma-separated thread counts to benchmark')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        print(f'fitting a forest to {args.synthetic:,d} random rows')
+        rf, rows, hour_col = synthetic_forest(args.synthetic)
+        pairs = rows[:args.pairs]
+        colnames = None
+    else:
+        import congestion_prediction_mp as cp
+        cp.initialize_worker()
+        rf, colnames = joblib.load(cp.MODEL_FILE)
+        files = sorted(glob('congestion_cache/chunk_*.parquet'))[:args.chunks]
+        pairs = np.concatenate([cp.chunk_features(f)[2] for f in files])
+        hour_col = cp.colnames.index('hour')
+    X = np.repeat(pairs, 24, axis=0)
+    X[:, hour_col] = np.tile(np.arange(24), len(pairs))
+    print(f'{len(X):,d} feature rows ({len(pairs):,d} pairs), {len(rf.estimators_)} trees')
+
+    start = time.perf_counter()
+    forest = export_forest(rf)
+    print(f'exported {len(forest["nodes"]):,d} nodes in {time.perf_counter() - start:.2f} s')
+
+    X_frame = pd.DataFrame(X, columns=colnames, copy=False) if colnames is not None else X
+    expected = rf.predict(X_frame)
+    sklearn_time = best_time(lambda: rf.predict(X_frame))
+
+    # compile
+    predict(forest, X[:1])
+    predict_hourly(forest, pairs[:1], hour_col)
+
+    for name, result in [('predict', predict(forest, X)), ('predict_hourly', predict_hourly(forest, pairs, hour_col).ravel())]:
+        print(f'max difference from rf.predict, {name}: {np.max(np.abs(result - expected)):.3g}')
+        assert np.array_equal(result, expected), f'{name} does not match rf.predict'
+
+    print(f'  rf.predict                         {len(X) / sklearn_time:14,.0f} rows/s')
+    for n_threads in map(int, args.threads.split(',')):
+        for name, func in [('predict', lambda: predict(forest, X, n_threads)),
+                ('predict_hourly', lambda: predict_hourly(forest, pairs, hour_col, n_threads=n_threads))]:
+            elapsed = best_time(func)
+            print(f'  {name:15s}, {n_threads:3d} threads {len(X) / elapsed:14,.0f} rows/s  {sklearn_time / elapsed:6.1f}x')
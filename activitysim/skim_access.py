@@ -0,0 +1,57 @@
+# Integer-indexed access to the ActivitySim skims. Tracts are referred to by their position in skim_tracts.parquet
+# (which is also their row/column in the OMX matrices), and values are looked up for whole arrays of origins and
+# destinations at once, rather than stacking full matrices into Series with a (from_geoid, to_geoid) MultiIndex.
+#
+# Matrices are only read when first used. Each one is converted once to a .npy file in a cache directory and then
+# memory-mapped, so multiple processes (and multiple scripts) share a single copy through the operating system's page
+# cache. The cache is rebuilt if the OMX file changes.
+
+import numpy as np
+import pandas as pd
+import openmatrix as omx
+import os
+import file_cache
+
+SKIM_FILE = '../la_abm/data/skims.omx'
+SKIM_TRACT_FILE = '../la_abm/data/skim_tracts.parquet'
+SKIM_CACHE = 'skim_cache'
+
+class Skims:
+    def __init__ (self, skim_file=SKIM_FILE, tract_file=SKIM_TRACT_FILE, cache_dir=SKIM_CACHE):
+        self.skim_file = skim_file
+        self.cache_dir = cache_dir
+        self.tracts = pd.read_parquet(tract_file)
+        self.geoids = pd.Index(self.tracts.geoid)
+        self.matrices = {}
+
+    # skim positions of an array of GEOIDs
+    def positions (self, geoids):
+        pos = self.geoids.get_indexer(geoids)
+        if (pos < 0).any():
+            raise KeyError(f'{np.sum(pos < 0)} tracts not found in skims, e.g. {np.asarray(geoids)[pos < 0][0]}')
+        return pos
+
+    # a full matrix, memory-mapped from the cache if there is one
+    def matrix (self, name):
+        if name not in self.matrices:
+            if self.cache_dir is None:
+                with omx.open_file(self.skim_file) as skims:
+                    self.matrices[name] = np.array(skims[name])
+            else:
+                self.matrices[name] = self._cached_matrix(name)
+        return self.matrices[name]
+
+    # values of matrix name for each pair of origins[i], destinations[i] (skim positions)
+    def gather (self, name, origins, destinations):
+        return self.matrix(name)[origins, destinations]
+
+    def _cached_matrix (self, name):
+        matrix_file = os.path.join(self.cache_dir, f'{name}.npy')
+
+        def build ():
+            print(f'caching skim {name} in {self.cache_dir}')
+            with omx.open_file(self.skim_file) as skims:
+                file_cache.save_npy(matrix_file, np.array(skims[name]))
+
+        file_cache.update_cache(self.skim_file, os.path.join(self.cache_dir, f'{name}.json'), build)
+        return np.load(matrix_file, mmap_mode='r')
@@ -0,0 +1,155 @@
+# Check the numba distance kernel and band assignment in congested_routes_mp.py against the original shapely
+# implementation (GeoSeries.distance to a LineString, then one filter per band). Run with pytest from this directory.
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import os
+from glob import glob
+import geopandas as gp
+import shapely.geometry
+import pytest
+import congested_routes_mp as cr
+
+# random tract centroids in a 30 km square, in meters, plus some on band edges and at segment endpoints
+def random_points (rng, n):
+    return rng.uniform(0, 30000, n), rng.uniform(0, 30000, n)
+
+# distances from the original worker: centroids to a two-point LineString, with shapely
+def shapely_distances (px, py, x0, y0, x1, y1):
+    return gp.GeoSeries(gp.points_from_xy(px, py)).distance(shapely.geometry.LineString(((x0, y0), (x1, y1)))).to_numpy()
+
+# the original band assignment, one filter per band: returns {(toidx, band): set of candidates}
+def shapely_bands (px, py, fridx, toidxs):
+    bands = {}
+    for toidx in toidxs:
+        distances = shapely_distances(px, py, px[fridx], py[fridx], px[toidx], py[toidx])
+        for band, (low, high) in enumerate(zip(cr.BAND_EDGES[:-1], cr.BAND_EDGES[1:])):
+            members = np.flatnonzero((distances > low * 1000) & (distances <= high * 1000))
+            if len(members) > 0:
+                bands[(toidx, band)] = set(members)
+    return bands
+
+@pytest.mark.parametrize('seed', range(5))
+def test_point_segment_distance (seed):
+    rng = np.random.default_rng(seed)
+    px, py = random_points(rng, 1000)
+    x0, y0, x1, y1 = rng.uniform(0, 30000, 4)
+    # the endpoints themselves, and points directly beside the segment
+    px = np.concatenate([px, [x0, x1, (x0 + x1) / 2]])
+    py = np.concatenate([py, [y0, y1, (y0 + y1) / 2 + 2000]])
+
+    distances = cr.point_segment_distance(px, py, x0, y0, x1, y1)
+    np.testing.assert_allclose(distances, shapely_distances(px, py, x0, y0, x1, y1), rtol=1e-12, atol=1e-9)
+    # origin and destination tracts must be exactly zero, so they are excluded from the (0, 2] band
+    assert distances[-3] == 0 and distances[-2] == 0
+
+def test_zero_length_segment ():
+    # origin and destination at the same point (e.g. two tracts with the same centroid)
+    rng = np.random.default_rng(0)
+    px, py = random_points(rng, 1000)
+    px[0], py[0] = 12345.5, 6789.25
+
+    distances = cr.point_segment_distance(px, py, px[0], py[0], px[0], py[0])
+    np.testing.assert_allclose(distances, shapely_distances(px, py, px[0], py[0], px[0], py[0]), rtol=1e-12, atol=1e-9)
+    assert distances[0] == 0
+
+def test_band_edges ():
+    # points exactly on the band edges go in the lower band, as with the original (low, high] filters
+    px = np.array([0, 10000, 5000, 5000, 5000, 5000, 5000, 5000])
+    py = np.array([0, 0, 0, 2000, 2000.001, 4000, 8000, 8000.001])
+    toidxs = np.array([1])
+    offsets = np.array([0, len(px)])
+    candidates = np.arange(len(px))
+
+    distances = cr.point_segment_distance(px.astype('float64'), py.astype('float64'), 0.0, 0.0, 10000.0, 0.0)
+    entry_toidx, entry_band, entry_length, members = cr.assign_bands(toidxs, offsets, candidates, distances)
+    result = dict(zip(entry_band, np.split(members, np.cumsum(entry_length)[:-1])))
+
+    assert {band: set(m) for band, m in result.items()} == {0: {3}, 1: {4, 5}, 3: {6}}
+
+@pytest.mark.parametrize('seed', range(3))
+def test_assign_bands (seed):
+    rng = np.random.default_rng(seed)
+    px, py = random_points(rng, 300)
+    # a destination at the same point as the origin
+    px[5], py[5] = px[0], py[0]
+    fridx = 0
+    toidxs = np.arange(1, len(px))
+
+    # every tract is a candidate for every destination, so this tests the kernel and banding, not the spatial index
+    candidates = np.tile(np.arange(len(px)), len(toidxs))
+    offsets = np.arange(len(toidxs) + 1) * len(px)
+    distances = cr.batch_point_segment_distance(px, py, offsets, candidates, np.full(len(toidxs), px[fridx]),
+        np.full(len(toidxs), py[fridx]), px[toidxs], py[toidxs])
+    entry_toidx, entry_band, entry_length, members = cr.assign_bands(toidxs, offsets, candidates, distances)
+
+    result = {(toidx, band): set(m) for toidx, band, m
+        in zip(entry_toidx, entry_band, np.split(members, np.cumsum(entry_length)[:-1]))}
+    assert result == shapely_bands(px, py, fridx, toidxs)
+
+def test_band_labels ():
+    band_edges, percentiles = cr.BAND_EDGES, cr.PERCENTILES
+    try:
+        cr.configure([0, 2.5, 4, 10, 20], cr.PERCENTILES)
+        labels = [cr.band_label(band) for band in range(len(cr.BAND_EDGES) - 1)]
+        assert labels == ['(0, 2.5]', '(2.5, 4]', '(4, 10]', '(10, 20]']
+        assert [cr.parse_band_label(label) for label in labels] == [(0, 2.5), (2.5, 4), (4, 10), (10, 20)]
+        # labels sort as strings in a different order
+        assert sorted(labels, key=cr.parse_band_label) == labels != sorted(labels)
+    finally:
+        cr.configure(band_edges, percentiles)
+
+# a result array for each origin in [0, n_tracts), in the format returned by worker
+def random_results (rng, n_tracts):
+    results = {}
+    for fridx in range(n_tracts):
+        toidx = np.arange(fridx + 1, n_tracts)
+        results[fridx, fridx + 1] = np.column_stack([np.full(len(toidx), fridx), toidx, toidx % (len(cr.BAND_EDGES) - 1),
+            rng.uniform(0, 1000, (len(toidx), len(cr.value_columns())))])
+    return results
+
+def read_results (directory):
+    table = pd.read_parquet(directory)
+    return table.sort_values(['fromidx', 'toidx'])[['fromidx', 'toidx', *cr.value_columns()]].to_numpy()
+
+def test_sharded_parquet_writer (tmp_path, monkeypatch):
+    monkeypatch.setattr(cr, 'ROW_GROUP_ROWS', 50)
+    monkeypatch.setattr(cr, 'PART_ROWS', 200)
+    n_tracts = 60
+    results = random_results(np.random.default_rng(0), n_tracts)
+    expected = np.concatenate(list(results.values()))[:, [0, 1, *range(3, 3 + len(cr.value_columns()))]]
+    geoids = np.array([f'{i:011d}' for i in range(n_tracts)])
+    directory = str(tmp_path / 'along_route.parquet')
+
+    # a run that dies partway through, before finishing its last part
+    writer = cr.ShardedParquetWriter(directory, geoids, {'run': 1})
+    for block in list(results)[:40]:
+        writer.write(*block, results[block])
+    writer.manifest.close()
+    assert 0 < len(writer.completed) < 40
+
+    with cr.ShardedParquetWriter(directory, geoids, {'run': 1}, resume=True) as writer:
+        for block in results:
+            if block not in writer.completed:
+                writer.write(*block, results[block])
+    np.testing.assert_array_equal(read_results(directory), expected)
+
+    # parts of about PART_ROWS rows in row groups of about ROW_GROUP_ROWS rows, and no leftover temporary files
+    parts = glob(os.path.join(directory, '*.parquet'))
+    assert len(parts) <= len(expected) // cr.PART_ROWS + 2
+    assert sorted(os.listdir(directory)) == sorted([*map(os.path.basename, parts), '_settings.json', '_complete.txt'])
+    for part in parts:
+        metadata = pq.ParquetFile(part).metadata
+        assert all(metadata.row_group(i).num_rows >= cr.ROW_GROUP_ROWS for i in range(metadata.num_row_groups - 1))
+
+    # shards merged into one output
+    shards = []
+    for shard, (origin_start, origin_end) in enumerate(cr.partition_origins(n_tracts, 3)):
+        shards.append(str(tmp_path / f'along_route_{shard}.parquet'))
+        with cr.ShardedParquetWriter(shards[-1], geoids, {'run': 1, 'shard': f'{shard}/3'}) as writer:
+            for fridx in range(origin_start, origin_end):
+                writer.write(fridx, fridx + 1, results[fridx, fridx + 1])
+    merged = str(tmp_path / 'merged.parquet')
+    cr.merge_outputs(shards, merged)
+    np.testing.assert_array_equal(read_results(merged), expected)
@@ -0,0 +1,63 @@
+# Check that forest_inference.py predicts exactly what rf.predict does, on a small forest fit like the congestion
+# model. Run with pytest from this directory.
+
+import numpy as np
+import pytest
+import forest_inference as fi
+
+@pytest.fixture(scope='module')
+def synthetic ():
+    rf, X, hour_col = fi.synthetic_forest(5000, n_trees=10, min_samples_split=20)
+    return rf, fi.export_forest(rf), X[:500], hour_col
+
+# every row of pairs for hours 0 ... 23
+def hourly_rows (pairs, hour_col):
+    X = np.repeat(pairs, 24, axis=0)
+    X[:, hour_col] = np.tile(np.arange(24), len(pairs))
+    return X
+
+def test_export (synthetic):
+    rf, forest, X, hour_col = synthetic
+    assert len(forest['nodes']) == sum(est.tree_.node_count for est in rf.estimators_)
+    np.testing.assert_array_equal(forest['depths'], [est.tree_.max_depth for est in rf.estimators_])
+    # every node is in exactly one tree
+    assert np.all(fi.node_depths(forest) >= 0)
+
+@pytest.mark.parametrize('n_threads', [1, None])
+def test_predict (synthetic, n_threads):
+    rf, forest, X, hour_col = synthetic
+    # rows with a feature just below, at and just above the (float32) threshold of each split
+    split = np.flatnonzero(np.isfinite(forest['nodes']['threshold']))[:len(X)]
+    threshold = forest['nodes']['threshold'][split]
+    edges = np.repeat(X[:len(split)], 3, axis=0)
+    for k, value in enumerate([np.nextafter(threshold, np.float32(-np.inf)), threshold,
+            np.nextafter(threshold, np.float32(np.inf))]):
+        edges[np.arange(len(split)) * 3 + k, forest['nodes']['feature'][split]] = value
+
+    for rows in [X, hourly_rows(X[:50], hour_col), edges]:
+        np.testing.assert_array_equal(fi.predict(forest, rows, n_threads), rf.predict(rows))
+
+def test_predict_hourly (synthetic):
+    rf, forest, X, hour_col = synthetic
+    expected = rf.predict(hourly_rows(X, hour_col)).reshape(len(X), 24)
+    np.testing.assert_array_equal(fi.predict_hourly(forest, X, hour_col, n_threads=1), expected)
+    # fewer pairs than a block, and a block that isn't full
+    np.testing.assert_array_equal(fi.predict_hourly(forest, X[:3], hour_col, n_threads=1), expected[:3])
+    n = fi.BLOCK_ROWS // 24 + 1
+    np.testing.assert_array_equal(fi.predict_hourly(forest, X[:n], hour_col, n_threads=1), expected[:n])
+
+def test_truncate_forest (synthetic):
+    rf, forest, X, hour_col = synthetic
+    np.testing.assert_array_equal(fi.predict(fi.truncate_forest(forest, n_trees=3), X, 1),
+        np.mean([est.predict(X) for est in rf.estimators_[:3]], axis=0))
+
+    # a tree cut off at max_depth predicts the value sklearn stores at the node each row reaches at that depth
+    depth = 4
+    tree = rf.estimators_[0].tree_
+    node = np.zeros(len(X), dtype='int64')
+    for _ in range(depth):
+        inner = tree.children_left[node] != -1
+        go_left = X[np.arange(len(X)), tree.feature[node]] <= tree.threshold[node]
+        node = np.where(inner, np.where(go_left, tree.children_left[node], tree.children_right[node]), node)
+    truncated = fi.truncate_forest(forest, n_trees=1, max_depth=depth)
+    np.testing.assert_array_equal(fi.predict(truncated, X, 1), tree.value[node, 0, 0])
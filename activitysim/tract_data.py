@@ -0,0 +1,69 @@
+# Tract centroid data shared between processes and between pipeline stages. tract_centroids_density.json is parsed
+# once and each column is cached as a .npy file. Later loads (in any stage) just memory-map the cache as long as the
+# GeoJSON hasn't changed, and multiprocessing workers memory-map the same files, so startup doesn't involve one
+# GeoJSON parse per process and the operating system shares the pages between processes.
+
+import numpy as np
+import pandas as pd
+import geopandas as gp
+import rtree
+import os
+import hashlib
+import file_cache
+
+TRACT_CACHE = 'tract_cache'
+TRACT_FILE = 'tract_centroids_density.json'
+
+# write the columns of tract_centroids (a GeoDataFrame of points) to directory, with the geometry as x and y columns
+def publish_tracts (tract_centroids, directory=TRACT_CACHE):
+    os.makedirs(directory, exist_ok=True)
+
+    columns = {
+        'x': tract_centroids.geometry.x.to_numpy(),
+        'y': tract_centroids.geometry.y.to_numpy()
+    }
+
+    for col in tract_centroids.columns:
+        if col == tract_centroids.geometry.name:
+            continue
+        values = tract_centroids[col].to_numpy()
+        if values.dtype == object or pd.api.types.is_string_dtype(values.dtype):
+            # fixed-width strings can be memory-mapped, Python objects can't
+            values = values.astype(str)
+        columns[col] = values
+
+    for col, values in columns.items():
+        file_cache.save_npy(os.path.join(directory, f'{col}.npy'), values)
+    file_cache.save_text(os.path.join(directory, 'columns.txt'), '\n'.join(columns))
+
+# hash of the GEOIDs in order, to check that outputs indexed by tract position were built for the same tracts
+def geoid_hash (geoids):
+    return hashlib.sha256('\n'.join(geoids).encode()).hexdigest()
+
+# memory-map published columns (all of them if columns is None), returning a dict of read-only arrays
+def load_tracts (directory=TRACT_CACHE, columns=None):
+    if columns is None:
+        with open(os.path.join(directory, 'columns.txt')) as f:
+            columns = f.read().split('\n')
+
+    return {col: np.load(os.path.join(directory, f'{col}.npy'), mmap_mode='r') for col in columns}
+
+# published columns as a DataFrame, with x and y columns instead of geometry
+def tract_frame (directory=TRACT_CACHE, columns=None):
+    return pd.DataFrame(load_tracts(directory, columns))
+
+# spatial index of tract centroids, with tract positions as ids. Bulk-loading is much faster than inserting one at a
+# time. The index isn't shared with workers through a file because rtree rewrites disk-based indices on close.
+def build_spatial_index (x, y):
+    return rtree.index.Index(((i, (px, py, px, py), None) for i, (px, py) in enumerate(zip(x, y))))
+
+# Load tract centroids as a DataFrame (with x and y columns rather than geometry), from the cache if it was built
+# from the current version of filename (see file_cache.update_cache). Otherwise the GeoJSON is parsed and the cache
+# rebuilt.
+def load_tract_centroids (filename=TRACT_FILE, directory=TRACT_CACHE):
+    def build ():
+        print(f'caching {filename} in {directory}')
+        publish_tracts(gp.read_file(filename), directory)
+
+    file_cache.update_cache(filename, os.path.join(directory, 'source.json'), build, check_hash=True)
+    return tract_frame(directory)
@@ -4,6 +4,7 @@ import numpy as np
 import geopandas as gp
 import rasterio.features
 import rasterio.transform
+import shapely
 import shapely.affinity
 import math
 import numba
@@ -11,6 +12,10 @@ import tqdm
 import csv
 import pandas as pd
 import multiprocessing
+import argparse
+import time
+import os
+import pickle
 
 DIMENSIONS = (
     (12, 10),
@@ -24,6 +29,39 @@ DIM_NAMES = (
     'fit_sixplex'
 )
 
+# The original fit test requires the rectangle to end strictly before the last row and column of the mask (see note
+# on page 34 of dissertation). Set to False to allow rectangles that touch the edge of the mask.
+STRICT_FIT = True
+
+# Rotations tested, in degrees. Only rotations through 90 degrees are needed, see rot_fit.
+ROTATIONS_DEG = np.arange(0, 90, 15)
+
+# In the adaptive rotation sweep (see rot_rectangles), the angle is refined around rotations where a building that
+# doesn't fit at any rotation comes within this fraction of fitting in both dimensions, halving the step down to
+# MIN_ROTATION_STEP degrees.
+ALMOST_FIT = 0.9
+MIN_ROTATION_STEP = 1.875
+
+# Prefilter rules (see prefilter), in the order they are applied
+UNRESOLVED, AREA, MIN_RECTANGLE, INSCRIBED_RECTANGLE = range(4)
+PREFILTER_RULES = {
+    AREA: 'rejected, area',
+    MIN_RECTANGLE: 'rejected, minimum rotated rectangle',
+    INSCRIBED_RECTANGLE: 'accepted, inscribed rectangle',
+    UNRESOLVED: 'rasterized'
+}
+
+# Number of centers tried for the inscribed rectangles in the prefilter, evenly spaced along the long axis of the
+# minimum rotated rectangle around the parcel
+INSCRIBED_CENTERS = 5
+
+# Parcels are sent to workers in batches of this many (see encode_batch)
+BATCH_SIZE = 500
+
+# For each parcel and rotation, the maximal rectangles that fit (see maximal_rectangles), so that fit for other
+# building footprints can be found without rerunning the sweep (see index_fits)
+RECTANGLE_FILE = 'max_rectangles.csv'
+
 
 # numba really does help here, 32us -> ~1us.
 @numba.jit(nopython=True)
@@ -45,10 +83,54 @@ def fits (mask, width, height):
     return False
 
 
-def rect_fit (geom, dims):
+@numba.jit(nopython=True)
+def integral_image (mask):
+    '''
+    Summed-area table of mask: sat[x, y] is the number of True pixels in mask[:x, :y]. With this, the number of True
+    pixels in any window is found in constant time, so one table answers fit tests for all dimensions.
+    '''
+    sat = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int32)
+    for x in range(mask.shape[0]):
+        row_count = 0
+        for y in range(mask.shape[1]):
+            row_count += mask[x, y]
+            sat[x + 1, y + 1] = sat[x, y + 1] + row_count
+    return sat
+
+
+@numba.jit(nopython=True)
+def _window_fits (sat, width, height, strict):
+    # windows spanning width along the first axis of the mask and height along the second
+    xmax = sat.shape[0] - 1 - width
+    ymax = sat.shape[1] - 1 - height
+    if not strict:
+        xmax += 1
+        ymax += 1
+    area = width * height
+    for x in range(xmax):
+        for y in range(ymax):
+            if sat[x + width, y + height] - sat[x, y + height] - sat[x + width, y] + sat[x, y] == area:
+                return True
+    return False
+
+
+@numba.jit(nopython=True)
+def fits_integral (sat, width, height, strict=True):
+    '''
+    Same test as fits, using the summed-area table of the mask from integral_image, so each candidate position is
+    checked in constant time rather than by scanning a width x height window. With strict=True, gives the same results
+    as fits (including its strict < at the edges of the mask); with strict=False, rectangles may touch the edge.
+    '''
+    return _window_fits(sat, width, height, strict) or _window_fits(sat, height, width, strict)
+
+
+def rasterize (geom):
+    '''
+    Rasterize geom to a mask with 1m pixels, or return None for null/empty geoms.
+    '''
     if geom is None or geom.is_empty:
         # short-circuit for null/empty geoms, rasterio.features.bounds chokes on empty geoms
-        return np.array([False for d in dims])
+        return None
 
     w, s, e, n = rasterio.features.bounds(geom)
     # force width/height to exact meters so pixels are whole meters
@@ -61,11 +143,157 @@ def rect_fit (geom, dims):
     width = int(round(e - w))
     height = int(round(n - s))
     xform = rasterio.transform.from_bounds(w, s, e, n, width, height)
-    mask = rasterio.features.geometry_mask(geom, (height, width), xform, invert=True)
-    return [fits(mask, w, h) for w, h in dims]
+    return rasterio.features.geometry_mask([geom], (height, width), xform, invert=True)
+
+
+def rect_fit (geom, dims, strict=STRICT_FIT):
+    mask = rasterize(geom)
+    if mask is None:
+        return np.array([False for d in dims])
+
+    sat = integral_image(mask)
+    return [fits_integral(sat, w, h, strict) for w, h in dims]
+
+
+# Reused by rasterize_rotated, so a new mask isn't allocated for every rotation of every parcel
+_raster_buffer = np.zeros(0, dtype=np.uint8)
+
+
+def rotated_bounds (coords, center, rotations_deg):
+    '''
+    Bounds (w, s, e, n) of the points in coords (an n x 2 array) rotated counterclockwise about center by each of
+    rotations_deg, as a rotations x 4 array. All rotations are computed at once, without building rotated geometries.
+    '''
+    theta = np.radians(np.asarray(rotations_deg, dtype='float64'))[:, None]
+    cos = np.cos(theta)
+    sin = np.sin(theta)
+    dx = coords[None, :, 0] - center[0]
+    dy = coords[None, :, 1] - center[1]
+    x = center[0] + cos * dx - sin * dy
+    y = center[1] + sin * dx + cos * dy
+    return np.stack([x.min(axis=1), y.min(axis=1), x.max(axis=1), y.max(axis=1)], axis=1)
 
 
-def rot_fit (geom, dims, rotations_deg=np.arange(0, 90, 15)):
+def rasterize_rotated (geom, rot, bounds, center):
+    '''
+    Same mask as rasterize(shapely.affinity.rotate(geom, rot, origin=center)), but geom is rasterized directly onto a
+    pixel grid rotated the other way, so no rotated geometry is built. bounds are the bounds of the rotated geometry,
+    from rotated_bounds. The mask is a view of a buffer that is overwritten by the next call.
+    '''
+    global _raster_buffer
+
+    w, s, e, n = bounds
+    w = math.floor(w)
+    s = math.floor(s)
+    n = math.ceil(n)
+    e = math.ceil(e)
+    width = int(round(e - w))
+    height = int(round(n - s))
+
+    if _raster_buffer.size < width * height:
+        _raster_buffer = np.zeros(max(width * height, 2 * _raster_buffer.size), dtype=np.uint8)
+    out = _raster_buffer[:width * height].reshape(height, width)
+    out[:] = 0
+
+    # pixels -> rotated coordinates -> coordinates of geom
+    xform = (rasterio.transform.Affine.rotation(-rot, pivot=center)
+        * rasterio.transform.from_bounds(w, s, e, n, width, height))
+    rasterio.features.rasterize([geom], out=out, transform=xform, default_value=1)
+    return out.view(np.bool_)
+
+
+def rotation_masks (geom, rotations_deg=ROTATIONS_DEG):
+    '''
+    Generate (rotation, mask) for each of rotations_deg, rotating about the center of the bounds of geom as
+    shapely.affinity.rotate does. Each mask is only valid until the next one is generated.
+    '''
+    if geom is None or geom.is_empty:
+        return
+
+    xmin, ymin, xmax, ymax = geom.bounds
+    center = ((xmin + xmax) / 2, (ymin + ymax) / 2)
+    for rot, bounds in zip(rotations_deg, rotated_bounds(shapely.get_coordinates(geom), center, rotations_deg)):
+        yield rot, rasterize_rotated(geom, rot, bounds, center)
+
+
+@numba.jit(nopython=True)
+def maximal_rectangles (mask, strict=True):
+    '''
+    Pareto frontier of the rectangles that fit inside mask: an array of (width, height) rows, width along the first axis
+    of the mask as in fits, such that a rectangle fits if and only if it is no larger in both dimensions than one of the
+    rows (in either orientation). Rows are sorted by decreasing width and increasing height. There are at most
+    min(mask.shape) of them, so they can be stored for each parcel and queried for any building footprint later.
+
+    Each row of the mask is treated as the base of a histogram of the number of consecutive True pixels ending there in
+    each column, and the largest rectangle under the histogram for each bar height is found with a stack, as in the
+    largest-rectangle-in-histogram problem. With strict=True, the last row and column of the mask are excluded, to
+    match fits.
+    '''
+    nx = mask.shape[0] - 1 if strict else mask.shape[0]
+    ny = mask.shape[1] - 1 if strict else mask.shape[1]
+    nx = max(nx, 0)
+    ny = max(ny, 0)
+
+    run = np.zeros(ny + 1, dtype=np.int64)  # run[ny] stays 0, to empty the stack at the end of each row
+    stack = np.empty(ny + 1, dtype=np.int64)
+    # best[w] is the greatest height of a rectangle exactly w wide found so far
+    best = np.zeros(nx + 1, dtype=np.int64)
+
+    for x in range(nx):
+        for y in range(ny):
+            run[y] = run[y] + 1 if mask[x, y] else 0
+
+        n_stack = 0
+        for y in range(ny + 1):
+            while n_stack > 0 and run[stack[n_stack - 1]] >= run[y]:
+                width = run[stack[n_stack - 1]]
+                n_stack -= 1
+                left = stack[n_stack - 1] if n_stack > 0 else -1
+                height = y - left - 1
+                if height > best[width]:
+                    best[width] = height
+            stack[n_stack] = y
+            n_stack += 1
+
+    out = np.empty((nx, 2), dtype=np.int32)
+    n_out = 0
+    height = 0
+    for width in range(nx, 0, -1):
+        if best[width] > height:
+            height = best[width]
+            out[n_out, 0] = width
+            out[n_out, 1] = height
+            n_out += 1
+    return out[:n_out]
+
+
+@numba.jit(nopython=True)
+def frontier_fits (frontier, width, height):
+    '''
+    Whether a width x height rectangle fits, in either orientation, given the frontier from maximal_rectangles.
+    '''
+    for i in range(frontier.shape[0]):
+        if ((frontier[i, 0] >= width and frontier[i, 1] >= height)
+                or (frontier[i, 0] >= height and frontier[i, 1] >= width)):
+            return True
+    return False
+
+
+@numba.jit(nopython=True)
+def frontier_fraction (frontier, width, height):
+    '''
+    How close a width x height rectangle comes to fitting, given the frontier from maximal_rectangles: the largest
+    fraction f such that a rectangle f times its size fits. At least 1 if it fits.
+    '''
+    best = 0.0
+    for i in range(frontier.shape[0]):
+        best = max(best,
+            min(frontier[i, 0] / width, frontier[i, 1] / height),
+            min(frontier[i, 0] / height, frontier[i, 1] / width))
+    return best
+
+
+def rot_fit (geom, dims, rotations_deg=ROTATIONS_DEG, strict=STRICT_FIT):
     '''
     Check if it fits for all possible rotations, 0-90 degrees. Only need to rotate through 90 degrees because fit()
     checks for fit both horizontally and vertically, and because rectangles are symmetrical.
@@ -74,13 +302,9 @@ def rot_fit (geom, dims, rotations_deg=np.arange(0, 90, 15)):
     dims = np.array(dims)
     out = np.array([False for dim in dims])
 
-    for rot in rotations_deg:
-        if rot == 0:
-            rot_geom = geom
-        else:
-            rot_geom = shapely.affinity.rotate(geom, rot, use_radians=False)
-
-        out[~out] |= rect_fit(rot_geom, dims[~out])
+    for rot, mask in rotation_masks(geom, rotations_deg):
+        sat = integral_image(mask)
+        out[~out] |= [fits_integral(sat, w, h, strict) for w, h in dims[~out]]
 
         if np.sum(~out) == 0:
             break
@@ -88,34 +312,467 @@ def rot_fit (geom, dims, rotations_deg=np.arange(0, 90, 15)):
     return out
 
 
+def shapely_rot_fit (geom, dims, rotations_deg=ROTATIONS_DEG):
+    '''
+    The original rotation sweep, rotating the geometry with shapely and rasterizing it afresh for each rotation. Kept to
+    test rot_fit against.
+    '''
+    out = np.array([False for dim in dims])
+    for rot in rotations_deg:
+        rot_geom = geom if rot == 0 else shapely.affinity.rotate(geom, rot, use_radians=False)
+        out[~out] |= rect_fit(rot_geom, np.array(dims)[~out])
+        if np.sum(~out) == 0:
+            break
+    return out
+
+
+def rot_rectangles (geom, rotations_deg=ROTATIONS_DEG, strict=STRICT_FIT, refine_dims=None, min_step=MIN_ROTATION_STEP):
+    '''
+    The maximal_rectangles frontier at each rotation, as a list of (rotation, frontier) sorted by rotation. Unlike
+    rot_fit this can't stop early once all dimensions fit, but any footprint can be tested against the result with
+    rectangles_fit.
+
+    With refine_dims (a list of building dimensions), the sweep is adaptive: while some of refine_dims don't fit, the
+    rotations where one of them comes within ALMOST_FIT of fitting are refined with rotations half the previous step
+    either side, down to min_step degrees. rotations_deg should then be evenly spaced.
+    '''
+    frontiers = {}
+
+    def sweep (rotations):
+        for rot, mask in rotation_masks(geom, rotations):
+            frontiers[rot] = maximal_rectangles(mask, strict)
+
+    sweep(rotations_deg)
+
+    if refine_dims is not None and len(frontiers) > 0:
+        step = np.min(np.diff(np.sort(rotations_deg))) if len(rotations_deg) > 1 else 90
+        candidates = list(frontiers)
+        while step / 2 >= min_step:
+            step /= 2
+            unfit = [(w, h) for w, h in refine_dims if not any(frontier_fits(f, w, h) for f in frontiers.values())]
+            near = [rot for rot in candidates
+                if any(frontier_fraction(frontiers[rot], w, h) >= ALMOST_FIT for w, h in unfit)]
+            # rotations 90 degrees apart give the same fits
+            new = sorted({(rot + offset) % 90 for rot in near for offset in (-step, step)} - frontiers.keys())
+            if len(new) == 0:
+                break
+            sweep(new)
+            candidates = near + new
+
+    return sorted(frontiers.items())
+
+
+def adaptive_rotations (rotations_deg=ROTATIONS_DEG, min_step=MIN_ROTATION_STEP):
+    '''
+    Every rotation the adaptive sweep in rot_rectangles could try, starting from rotations_deg. Rotations are only
+    refined by halving the step, so they all lie on a grid of the smallest step, offset by each of rotations_deg.
+    '''
+    rotations_deg = np.asarray(rotations_deg, dtype='float64')
+    step = np.min(np.diff(np.sort(rotations_deg))) if len(rotations_deg) > 1 else 90
+    while step / 2 >= min_step:
+        step /= 2
+    return np.unique((rotations_deg[:, None] + np.arange(0, 90, step)[None, :]) % 90)
+
+
+def rectangles_fit (rectangles, dims):
+    '''
+    Same result as rot_fit, from the output of rot_rectangles.
+    '''
+    return np.array([any(frontier_fits(frontier, w, h) for rot, frontier in rectangles) for w, h in dims])
+
+
+def load_rectangle_index (filename=RECTANGLE_FILE):
+    return pd.read_csv(filename, dtype={'apn': str})
+
+
+def index_fits (index, width, height, gids=None):
+    '''
+    Whether a width x height building fits on each parcel, from the rectangle index written by the parcel sweep (see
+    load_rectangle_index), as a Series indexed by gid. Parcels with no rectangles (empty geometries, and parcels where
+    the prefilter rules out every building in DIMENSIONS, see batch_fit) are not in the index; pass gids to include
+    them (as False). So footprints smaller than all of DIMENSIONS may be reported not to fit on those parcels.
+    '''
+    fit = (((index.width >= width) & (index.height >= height)) | ((index.width >= height) & (index.height >= width)))
+    fit = fit.groupby(index.gid.to_numpy()).any()
+    if gids is not None:
+        fit = fit.reindex(gids, fill_value=False)
+    return fit.rename_axis('gid')
+
+
+def prefilter_batch (geoms, dims, rotations_deg=ROTATIONS_DEG, adaptive=False):
+    '''
+    Decide whether dims fit on each of an array of geometries without rasterizing, where cheap geometric tests make the
+    answer obvious. Returns an array of fits and an array of the rule that decided each one (both geometries x dims,
+    UNRESOLVED where the raster test is still needed). The tests run on the whole batch at once with shapely's array
+    functions, so there is little per-geometry overhead.
+
+    A building fits in the raster test when a block of pixels that size is inside geom, and the pixel centers of that
+    block span a rectangle one meter smaller in each dimension. That rectangle is inside the convex hull of geom (even
+    where geom has holes or notches between the pixel centers), so a building is rejected if the rectangle has more
+    area than the convex hull (AREA), or can't fit in the minimum rotated rectangle around geom when aligned with the
+    pixel grid at any of rotations_deg (MIN_RECTANGLE). A building is accepted if a rectangle two meters larger than
+    it in each dimension, aligned with the pixel grid at one of rotations_deg and centered on one of INSCRIBED_CENTERS
+    points along the long axis of the minimum rotated rectangle, is inside geom (INSCRIBED_RECTANGLE); only the
+    rotation and orientation where that rectangle has the most room in the minimum rotated rectangle are tried. Such a
+    rectangle contains a block of pixel centers the size of the building that avoids the edge of the mask, so the
+    results are the same as rot_fit with the same rotations.
+
+    With adaptive, MIN_RECTANGLE only rejects buildings that can't fit at any rotation the adaptive sweep could try
+    (see adaptive_rotations), so a rejected building doesn't fit in the adaptive sweep in rot_rectangles either.
+    '''
+    geoms = np.asarray(geoms, dtype=object)
+    dims = np.array(dims)
+    fit = np.zeros((len(geoms), len(dims)), dtype='bool')
+    rule = np.full((len(geoms), len(dims)), UNRESOLVED, dtype='int8')
+
+    # the rectangle spanned by the pixel centers of a block the size of each building
+    span = dims - 1
+    valid = np.flatnonzero(~shapely.is_missing(geoms) & ~shapely.is_empty(geoms))
+    hull_area = shapely.area(shapely.convex_hull(geoms[valid]))
+    rule[valid] = np.where(hull_area[:, None] < span.prod(axis=1)[None, :], AREA, UNRESOLVED)
+
+    # minimum_rotated_rectangle of a degenerate geom is a line or a point
+    min_rect = shapely.minimum_rotated_rectangle(geoms[valid])
+    degenerate = shapely.get_num_coordinates(min_rect) != 5
+    rule[valid[degenerate]] = np.where(rule[valid[degenerate]] == UNRESOLVED, MIN_RECTANGLE, rule[valid[degenerate]])
+    # the rest of the tests are on the geometries with a minimum rotated rectangle (rows of fit and rule)
+    rows = valid[~degenerate]
+    rect_geoms = geoms[rows]
+    min_rect = min_rect[~degenerate]
+    if len(rows) == 0:
+        return fit, rule
+
+    # the minimum rotated rectangles have sides along angle and perpendicular to it. The pixel grid at rotation rot is
+    # rotated by -rot relative to geom (rotation_masks rotates geom counterclockwise).
+    corners = shapely.get_coordinates(min_rect).reshape(len(rows), 5, 2)
+    sides = np.hypot(*np.diff(corners[:, :3], axis=1).transpose(2, 0, 1))
+    angle = np.arctan2(corners[:, 1, 1] - corners[:, 0, 1], corners[:, 1, 0] - corners[:, 0, 0])
+    theta = np.radians(np.asarray(rotations_deg, dtype='float64'))
+
+    def room (size, theta=theta):
+        # how much room there is around a rectangle of size (each of dims, aligned with the grid, in each orientation
+        # and at each rotation in theta) in each minimum rotated rectangle, as orientation x geometry x dims x
+        # rotation. A rectangle fits in another at a fixed angle if and only if its projections on the sides of the
+        # other fit.
+        cos = np.abs(np.cos(angle[:, None] + theta[None, :]))[None, :, None, :]
+        sin = np.abs(np.sin(angle[:, None] + theta[None, :]))[None, :, None, :]
+        a = np.stack([size[:, 0], size[:, 1]])[:, None, :, None]
+        b = np.stack([size[:, 1], size[:, 0]])[:, None, :, None]
+        return np.minimum(sides[None, :, 0, None, None] - (a * cos + b * sin),
+            sides[None, :, 1, None, None] - (a * sin + b * cos))
+
+    reject_theta = np.radians(adaptive_rotations(rotations_deg)) if adaptive else theta
+    unfit = ~(room(span, reject_theta) >= -1e-6).any(axis=(0, 3))
+    rule[rows] = np.where((rule[rows] == UNRESOLVED) & unfit, MIN_RECTANGLE, rule[rows])
+
+    # rectangles two meters larger than each building are tried at the orientation and rotation with the most room
+    # in the minimum rotated rectangle (creating geometries is most of the cost here, so only one per center)
+    large_room = room(dims + 2).transpose(1, 2, 0, 3).reshape(len(rows), len(dims), -1)
+    best = large_room.argmax(axis=2)
+    possible = (rule[rows] == UNRESOLVED) & (np.take_along_axis(large_room, best[:, :, None], axis=2)[:, :, 0] >= 0)
+    geom_idx, dim_idx = np.nonzero(possible)
+    if len(geom_idx) == 0:
+        return fit, rule
+    orientation, rot_idx = np.unravel_index(best[geom_idx, dim_idx], (2, len(theta)))
+
+    # in the coordinates of geom, centered at points along the long axis of the minimum rotated rectangle
+    half = np.where(orientation[:, None] == 0, dims[dim_idx], dims[dim_idx, ::-1]) / 2 + 1
+    corner_signs = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1], [-1, -1]])
+    dx = half[:, None, None, 0] * corner_signs[:, 0]
+    dy = half[:, None, None, 1] * corner_signs[:, 1]
+    cos = np.cos(theta[rot_idx])[:, None, None]
+    sin = np.sin(theta[rot_idx])[:, None, None]
+
+    long_axis = np.where((sides[:, 1] > sides[:, 0])[:, None], corners[:, 2] - corners[:, 1], corners[:, 1] - corners[:, 0])
+    centers = (shapely.get_coordinates(shapely.centroid(min_rect))[:, None, :]
+        + np.linspace(-0.5, 0.5, INSCRIBED_CENTERS + 2)[None, 1:-1, None] * long_axis[:, None, :])[geom_idx]
+    x = centers[:, :, None, 0] + cos * dx + sin * dy
+    y = centers[:, :, None, 1] - sin * dx + cos * dy
+    boxes = shapely.polygons(np.stack([x, y], axis=-1))
+
+    shapely.prepare(rect_geoms)
+    inside = shapely.contains(rect_geoms[geom_idx, None], boxes).any(axis=1)
+    shapely.destroy_prepared(rect_geoms)
+
+    fit[rows[geom_idx[inside]], dim_idx[inside]] = True
+    rule[rows[geom_idx[inside]], dim_idx[inside]] = INSCRIBED_RECTANGLE
+    return fit, rule
+
+
+def prefilter (geom, dims, rotations_deg=ROTATIONS_DEG, adaptive=False):
+    '''
+    prefilter_batch for a single geometry, returning arrays of fits and rules for dims
+    '''
+    fit, rule = prefilter_batch(np.array([geom], dtype=object), dims, rotations_deg, adaptive)
+    return fit[0], rule[0]
+
+
+def prefiltered_fit (geom, dims, adaptive=False):
+    '''
+    Same result as rot_fit (or the adaptive sweep in rot_rectangles, if adaptive; see batch_fit), only rasterizing
+    when the prefilter doesn't decide all of dims. Returns the fits and the prefilter rule for each of dims.
+    '''
+    fit, rules, rectangles = batch_fit(np.array([geom], dtype=object), dims, adaptive)
+    return fit[0], rules[0]
+
+
+def encode_batch (gids, apns, geoms):
+    '''
+    A batch of parcels for the task queue: arrays of gid and apn, the WKB of all the geometries concatenated, and the
+    offsets of each geometry in it (null geometries have no WKB). This pickles much faster than a tuple per parcel.
+    '''
+    wkbs = shapely.to_wkb(geoms)
+    lengths = np.array([0 if wkb is None else len(wkb) for wkb in wkbs], dtype='int64')
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return np.asarray(gids), np.asarray(apns), b''.join(wkb for wkb in wkbs if wkb is not None), offsets
+
+
+def decode_batch (gids, apns, wkb, offsets):
+    '''
+    gids, apns, and an array of geometries from a batch made by encode_batch
+    '''
+    wkbs = np.array([wkb[start:end] if end > start else None for start, end in zip(offsets[:-1], offsets[1:])],
+        dtype=object)
+    return gids, apns, shapely.from_wkb(wkbs)
+
+
+def batch_fit (geoms, dims=DIMENSIONS, adaptive=False, index=False):
+    '''
+    Fit dims on each of an array of geometries. Returns fits and prefilter rules (geometries x dims), and the rectangle
+    index for the batch as a tuple of arrays (position in geoms, rotation, width, height), empty unless index.
+
+    The whole batch is prefiltered first (see prefilter_batch). Without index, only buildings the prefilter leaves
+    unresolved are tested with rot_fit, which stops once they all fit. The index needs the full sweep (see
+    rot_rectangles), with no early exit, so it costs several times as much per parcel; parcels where the prefilter
+    rejects every building are still not swept, and are left out of the index. With adaptive, rotations are only
+    refined for buildings the prefilter didn't reject, since those can't fit at any rotation the sweep could try.
+    '''
+    dims = np.array(dims)
+    fit, rules = prefilter_batch(geoms, dims, adaptive=adaptive)
+    rejected = (rules == AREA) | (rules == MIN_RECTANGLE)
+    rectangles = []
+
+    for i, geom in enumerate(geoms):
+        unresolved = rules[i] == UNRESOLVED
+        refine_dims = dims[~rejected[i]] if adaptive else None
+        if index and not rejected[i].all():
+            geom_rectangles = rot_rectangles(geom, refine_dims=refine_dims)
+            fit[i, unresolved] = rectangles_fit(geom_rectangles, dims[unresolved])
+            rectangles.extend((i, rot, w, h) for rot, frontier in geom_rectangles for w, h in frontier)
+        elif unresolved.any():
+            if adaptive:
+                fit[i, unresolved] = rectangles_fit(rot_rectangles(geom, refine_dims=refine_dims), dims[unresolved])
+            else:
+                fit[i, unresolved] = rot_fit(geom, dims[unresolved])
+
+    rectangles = np.array(rectangles, dtype='float64').reshape(-1, 4)
+    return fit, rules, (rectangles[:, 0].astype('int32'), rectangles[:, 1], rectangles[:, 2].astype('int32'),
+        rectangles[:, 3].astype('int32'))
+
+
 def queue_filler (task_queue):
     for chunk in gp.read_postgis('SELECT gid, apn, ST_Transform(geog::geometry, 26911) AS geom FROM diss.buildable_areas',
                                  'postgresql://matthewc@localhost:5432/matthewc',
                                  chunksize=5000):
-        for row in chunk.itertuples(index=False):
-            # namedtuples don't pickle nicely
-            task_queue.put(tuple(row), block=True)  # block if queue is full
+        for start in range(0, len(chunk), BATCH_SIZE):
+            batch = chunk.iloc[start:start + BATCH_SIZE]
+            task_queue.put(encode_batch(batch.gid.to_numpy(), batch.apn.to_numpy(), batch.geom.to_numpy()),
+                block=True)  # block if queue is full
 
 
-def queue_consumer (task_queue, result_queue):
+def queue_consumer (task_queue, result_queue, adaptive=False, index=False):
     while True:
-        gid, apn, geom = task_queue.get(block=True)
-        res = rot_fit(geom, DIMENSIONS)
-        result_queue.put((gid, apn, *res), block=True)
+        gids, apns, geoms = decode_batch(*task_queue.get(block=True))
+        fit, rules, rectangles = batch_fit(geoms, DIMENSIONS, adaptive, index)
+        # fits packed to bits, one row per parcel
+        result_queue.put((gids, apns, np.packbits(fit), rules, rectangles), block=True)
+
+
+def print_prefilter_report (rule_counts):
+    '''
+    Print how many parcels each prefilter rule decided for each building, from an array of counts (rule x building)
+    '''
+    total = rule_counts[:, 0].sum()
+    print(f'{"":36s}' + ''.join(f'{name:>16s}' for name in DIM_NAMES))
+    for rule, name in PREFILTER_RULES.items():
+        print(f'{name:36s}' + ''.join(f'{count:10,d} {count / total:5.1%}' for count in rule_counts[rule]))
+
+
+def random_mask (rng, max_size):
+    '''
+    A random mask for testing: a union of a few random rectangles and ellipses, with some holes.
+    '''
+    shape = rng.integers(1, max_size, 2)
+    xs, ys = np.mgrid[:shape[0], :shape[1]]
+    mask = np.zeros(shape, dtype=np.bool_)
+    for i in range(rng.integers(1, 4)):
+        cx, cy = rng.uniform(0, shape)
+        rx, ry = rng.uniform(1, shape)
+        if rng.random() < 0.5:
+            mask |= (np.abs(xs - cx) <= rx / 2) & (np.abs(ys - cy) <= ry / 2)
+        else:
+            mask |= ((xs - cx) / rx) ** 2 + ((ys - cy) / ry) ** 2 <= 0.25
+    mask &= rng.random(shape) > 0.002
+    return mask
+
+
+def random_parcel (rng):
+    '''
+    A random parcel-like polygon for testing: a rotated union of a rectangle and a circle, in meters.
+    '''
+    x, y = rng.uniform(0, 1000, 2)
+    lot = shapely.box(x, y, x + rng.uniform(5, 60), y + rng.uniform(5, 60))
+    lot = lot.union(shapely.Point(x + rng.uniform(0, 40), y + rng.uniform(0, 40)).buffer(rng.uniform(2, 20)))
+    return shapely.affinity.rotate(lot, rng.uniform(0, 90))
+
+
+def random_lot (rng):
+    '''
+    A random single-family-like lot for testing: a long, narrow rotated rectangle, sometimes with a corner cut off.
+    '''
+    x, y = rng.uniform(0, 1000, 2)
+    width, depth = rng.uniform(8, 25), rng.uniform(25, 60)
+    lot = shapely.box(x, y, x + width, y + depth)
+    if rng.random() < 0.3:
+        lot = lot.difference(shapely.Point(x, y).buffer(rng.uniform(3, width)))
+    return shapely.affinity.rotate(lot, rng.uniform(0, 90))
+
+
+def random_porous_lot (rng):
+    '''
+    A random lot for testing with a hole around every whole-meter point inside it, so the pixel centers of the
+    unrotated mask miss the holes and a building can fit on a lot with less area than the building.
+    '''
+    x, y = rng.integers(0, 1000, 2)
+    width, depth = rng.integers(13, 15), rng.integers(11, 13)
+    holes = [shapely.box(x + i - 0.35, y + j - 0.35, x + i + 0.35, y + j + 0.35)
+        for i in range(1, width) for j in range(1, depth)]
+    return shapely.box(x, y, x + width, y + depth).difference(shapely.union_all(holes))
+
+
+def benchmark (n_parcels, seed=0):
+    '''
+    Compare the speed of the fit tests on random masks and parcels. test_polygon_polygon_test.py checks that they give
+    the same results.
+    '''
+    rng = np.random.default_rng(seed)
+
+    def per_item (func, items):
+        # seconds per item, after a first call so compilation isn't timed
+        func(items[0])
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        return (time.perf_counter() - start) / len(items)
+
+    # large lots, where the scan in fits is slowest, particularly when nothing fits
+    xs, ys = np.mgrid[:300, :300]
+    radius = np.hypot(xs - 150, ys - 150)
+    mask_sets = {
+        'large lots': [random_mask(rng, 400) for i in range(20)],
+        'large lots with many holes': [mask & (rng.random(mask.shape) > 0.05) for mask in (random_mask(rng, 400) for i in range(20))],
+        'narrow rings (nothing fits)': [(radius < 150) & (radius > 142)] * 20
+    }
+
+    def integral_fits (mask):
+        sat = integral_image(mask)
+        return [fits_integral(sat, w, h) for w, h in DIMENSIONS]
+
+    for name, masks in mask_sets.items():
+        fits_time = per_item(lambda mask: [fits(mask, w, h) for w, h in DIMENSIONS], masks)
+        integral_time = per_item(integral_fits, masks)
+        frontier_time = per_item(maximal_rectangles, masks)
+        frontiers = [maximal_rectangles(mask) for mask in masks]
+        query_time = per_item(lambda frontier: [frontier_fits(frontier, w, h) for w, h in DIMENSIONS], frontiers) / len(DIMENSIONS)
+        print(f'{name}: fits {fits_time * 1e3:.2f} ms/mask, fits_integral {integral_time * 1e3:.2f} ms/mask, '
+            f'maximal_rectangles {frontier_time * 1e3:.2f} ms/mask then {query_time * 1e6:.2f} us/query')
+
+    parcels = [random_parcel(rng) for i in range(n_parcels)]
+    fine = np.arange(0, 90, MIN_ROTATION_STEP)
+    sweeps = {
+        f'shapely rotation, {len(ROTATIONS_DEG)} rotations': lambda parcel: shapely_rot_fit(parcel, DIMENSIONS),
+        f'rot_fit, {len(ROTATIONS_DEG)} rotations': lambda parcel: rot_fit(parcel, DIMENSIONS),
+        f'rot_rectangles, {len(ROTATIONS_DEG)} rotations': lambda parcel: rectangles_fit(rot_rectangles(parcel), DIMENSIONS),
+        f'rot_rectangles, {len(fine)} rotations': lambda parcel: rectangles_fit(rot_rectangles(parcel, fine), DIMENSIONS),
+        f'rot_rectangles, adaptive to {MIN_ROTATION_STEP} degrees':
+            lambda parcel: rectangles_fit(rot_rectangles(parcel, refine_dims=DIMENSIONS), DIMENSIONS)
+    }
+    for name, sweep in sweeps.items():
+        elapsed = per_item(sweep, parcels)
+        n_fit = np.sum([sweep(parcel) for parcel in parcels], axis=0)
+        print(f'{name}: {elapsed * 1e3:.2f} ms/parcel, fits {", ".join(map(str, n_fit))} of {len(parcels)}')
+
+    # batch_fit, with and without the rectangle index (--index), against the sweeps it stands in for
+    lot_sets = {
+        'random parcels': parcels,
+        'single-family lots': [random_lot(rng) for i in range(n_parcels)],
+        'porous lots': [random_porous_lot(rng) for i in range(n_parcels)]
+    }
+    def per_lot (func, lots):
+        start = time.perf_counter()
+        result = func(np.array(lots, dtype=object))
+        return (time.perf_counter() - start) / len(lots), result
+
+    for name, lots in lot_sets.items():
+        for adaptive in (False, True):
+            refine_dims = DIMENSIONS if adaptive else None
+            if adaptive:
+                sweep_time = per_item(lambda lot: rectangles_fit(rot_rectangles(lot, refine_dims=DIMENSIONS), DIMENSIONS), lots)
+            else:
+                sweep_time = per_item(lambda lot: rot_fit(lot, DIMENSIONS), lots)
+            index_sweep_time = per_item(lambda lot: rot_rectangles(lot, refine_dims=refine_dims), lots)
+            batch_time, (fit, rules, rectangles) = per_lot(lambda batch: batch_fit(batch, DIMENSIONS, adaptive), lots)
+            index_time = per_lot(lambda batch: batch_fit(batch, DIMENSIONS, adaptive, index=True), lots)[0]
+            prefilter_time = per_lot(lambda batch: prefilter_batch(batch, DIMENSIONS, adaptive=adaptive), lots)[0]
+
+            rule_counts = np.zeros((len(PREFILTER_RULES), len(DIMENSIONS)), dtype='int64')
+            np.add.at(rule_counts, (rules, np.arange(len(DIMENSIONS))), 1)
+            sweep = 'adaptive sweep' if adaptive else 'rot_fit'
+            print(f'{name}{", adaptive" if adaptive else ""}: batch_fit {batch_time * 1e3:.2f} ms/lot (prefilter_batch '
+                f'{prefilter_time * 1e3:.2f}), {sweep} {sweep_time * 1e3:.2f} ms/lot; with the index, batch_fit '
+                f'{index_time * 1e3:.2f} ms/lot, rot_rectangles {index_sweep_time * 1e3:.2f} ms/lot')
+            print_prefilter_report(rule_counts)
+
+    # queue overhead per parcel
+    lots = np.array(parcels, dtype=object)
+    gids = np.arange(len(lots))
+    apns = np.array([f'{gid:010d}' for gid in gids], dtype=object)
+    tasks = list(zip(gids, apns, lots))
+    per_parcel_time = per_item(lambda i: [pickle.loads(pickle.dumps(task)) for task in tasks], range(20)) / len(lots)
+    batch_time = per_item(lambda i: decode_batch(*pickle.loads(pickle.dumps(encode_batch(gids, apns, lots)))), range(20)) / len(lots)
+    print(f'task transport: one tuple per parcel {per_parcel_time * 1e6:.1f} us/parcel, batches {batch_time * 1e6:.1f} us/parcel')
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', type=int, default=None, metavar='N',
+        help='compare the speed of the fit tests on N random parcels, rather than running the parcel sweep')
+    parser.add_argument('--adaptive', action='store_true',
+        help=f'refine rotations where a building almost fits, down to {MIN_ROTATION_STEP} degree steps')
+    parser.add_argument('--index', action='store_true',
+        help=f'also write the rectangle index {RECTANGLE_FILE}, for testing other building footprints later (see '
+            'index_fits). This rasterizes every parcel at every rotation, which takes several times as long per parcel '
+            '(see --benchmark); without it, parcels that cheap geometric tests decide are not rasterized at all, and '
+            'the sweep for the rest stops once all buildings fit')
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        benchmark(args.benchmark)
+        raise SystemExit
+
     total = pd.read_sql('SELECT count(*) FROM diss.buildable_areas', 'postgresql://matthewc@localhost:5432/matthewc').iloc[0, 0]
     multiprocessing.set_start_method('spawn')
-    task_queue = multiprocessing.Queue(5000)
-    result_queue = multiprocessing.Queue(5000)
+    # queues of batches, holding about as many parcels as before parcels were batched
+    queue_size = max(5000 // BATCH_SIZE, 2 * multiprocessing.cpu_count())
+    task_queue = multiprocessing.Queue(queue_size)
+    result_queue = multiprocessing.Queue(queue_size)
 
     # start processes
     fill_process = multiprocessing.Process(target=queue_filler, args=(task_queue,))
     fill_process.start()
 
     compute_processes = [
-        multiprocessing.Process(target=queue_consumer, args=(task_queue, result_queue))
+        multiprocessing.Process(target=queue_consumer, args=(task_queue, result_queue, args.adaptive, args.index))
         for i in range(multiprocessing.cpu_count())
     ]
 
@@ -123,15 +780,25 @@ if __name__ == '__main__':
         p.start()
 
     # write output in main thread so we know when to stop
-    with open('dim_fit.csv', 'w') as out:
+    rule_counts = np.zeros((len(PREFILTER_RULES), len(DIMENSIONS)), dtype='int64')
+    with open('dim_fit.csv', 'w') as out, open(RECTANGLE_FILE if args.index else os.devnull, 'w') as rect_out:
         writer = csv.writer(out)
         writer.writerow(['gid', 'apn', *DIM_NAMES])
+        rect_writer = csv.writer(rect_out)
+        rect_writer.writerow(['gid', 'apn', 'rotation', 'width', 'height'])
         with tqdm.tqdm(total=total) as pbar:
             count = 0
             while count < total:
-                writer.writerow(result_queue.get(block=True))
-                count += 1
-                pbar.update(1)
+                gids, apns, packed_fit, rules, (rect_pos, rotation, width, height) = result_queue.get(block=True)
+                fit = np.unpackbits(packed_fit, count=len(gids) * len(DIMENSIONS)).reshape(len(gids), -1).astype('bool')
+                writer.writerows([(gid, apn, *gid_fit) for gid, apn, gid_fit in zip(gids, apns, fit.tolist())])
+                rect_writer.writerows(zip(gids[rect_pos], apns[rect_pos], [f'{rot:g}' for rot in rotation], width, height))
+                np.add.at(rule_counts, (rules, np.arange(len(DIMENSIONS))), 1)
+                count += len(gids)
+                pbar.update(len(gids))
+
+    if not args.index:
+        print_prefilter_report(rule_counts)
 
     fill_process.terminate()
     for p in compute_processes:
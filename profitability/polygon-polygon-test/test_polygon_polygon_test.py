@@ -0,0 +1,169 @@
+# Check the fit tests in polygon_polygon_test.py against the original implementations (fits, and rasterizing
+# geometries rotated with shapely) and against each other. Run with pytest from this directory; run
+# polygon_polygon_test.py --benchmark N to compare their speed.
+
+import numpy as np
+import shapely
+import shapely.affinity
+import pickle
+import pytest
+import polygon_polygon_test as ppt
+
+# the buildings, plus some that are very small or very narrow
+TEST_DIMS = [*ppt.DIMENSIONS, (1, 1), (3, 7), (30, 2)]
+
+def random_masks (seed, n=50, max_size=80):
+    rng = np.random.default_rng(seed)
+    return [ppt.random_mask(rng, max_size) for i in range(n)]
+
+# whether a width x height block of True pixels is anywhere in mask, in either orientation, touching the edge or not
+def brute_force_fits (mask, width, height):
+    for a, b in ((width, height), (height, width)):
+        if a <= mask.shape[0] and b <= mask.shape[1]:
+            if np.lib.stride_tricks.sliding_window_view(mask, (a, b)).all(axis=(2, 3)).any():
+                return True
+    return False
+
+@pytest.mark.parametrize('seed', range(4))
+def test_fits_integral (seed):
+    for i, mask in enumerate(random_masks(seed)):
+        sat = ppt.integral_image(mask)
+        for width, height in TEST_DIMS:
+            assert ppt.fits_integral(sat, width, height, True) == ppt.fits(mask, width, height), \
+                f'strict fit differs for {width}x{height} on mask {i}'
+            assert ppt.fits_integral(sat, width, height, False) == brute_force_fits(mask, width, height), \
+                f'non-strict fit differs for {width}x{height} on mask {i}'
+
+@pytest.mark.parametrize('seed', range(4))
+def test_maximal_rectangles (seed):
+    for i, mask in enumerate(random_masks(seed)):
+        sat = ppt.integral_image(mask)
+        strict_frontier = ppt.maximal_rectangles(mask, True)
+        frontier = ppt.maximal_rectangles(mask, False)
+        for width, height in TEST_DIMS:
+            assert ppt.frontier_fits(strict_frontier, width, height) == ppt.fits(mask, width, height), \
+                f'strict frontier fit differs for {width}x{height} on mask {i}'
+            assert ppt.frontier_fits(frontier, width, height) == brute_force_fits(mask, width, height), \
+                f'non-strict frontier fit differs for {width}x{height} on mask {i}'
+
+        # every rectangle on the frontier fits, and is maximal
+        for w, h in frontier:
+            assert ppt._window_fits(sat, w, h, False) and not ppt._window_fits(sat, w + 1, h, False) \
+                and not ppt._window_fits(sat, w, h + 1, False), f'frontier rectangle {w}x{h} is not maximal on mask {i}'
+
+def test_rotation_masks ():
+    rng = np.random.default_rng(0)
+    n_pixels = 0
+    n_different = 0
+    for i in range(30):
+        parcel = ppt.random_parcel(rng)
+        xmin, ymin, xmax, ymax = parcel.bounds
+        center = ((xmin + xmax) / 2, (ymin + ymax) / 2)
+        for rot, mask in ppt.rotation_masks(parcel, np.arange(0, 90, 7.5)):
+            expected = ppt.rasterize(shapely.affinity.rotate(parcel, rot, origin=center))
+            assert mask.shape == expected.shape, f'rotated mask has shape {mask.shape}, expected {expected.shape}'
+            n_pixels += mask.size
+            n_different += np.sum(mask != expected)
+
+    # pixel centers exactly on the boundary may go either way with rounding
+    assert n_different <= n_pixels * 1e-4
+
+def test_rot_fit ():
+    rng = np.random.default_rng(1)
+    for i in range(30):
+        parcel = ppt.random_parcel(rng)
+        np.testing.assert_array_equal(ppt.rot_fit(parcel, ppt.DIMENSIONS), ppt.shapely_rot_fit(parcel, ppt.DIMENSIONS))
+        np.testing.assert_array_equal(ppt.rectangles_fit(ppt.rot_rectangles(parcel), ppt.DIMENSIONS),
+            ppt.rot_fit(parcel, ppt.DIMENSIONS))
+
+def test_adaptive_rotations ():
+    rng = np.random.default_rng(2)
+    reachable = set(ppt.adaptive_rotations())
+    for i in range(30):
+        rotations = [rot for rot, frontier in ppt.rot_rectangles(ppt.random_parcel(rng), refine_dims=ppt.DIMENSIONS)]
+        assert set(rotations) <= reachable
+
+LOT_TYPES = [ppt.random_parcel, ppt.random_lot, ppt.random_porous_lot]
+
+# buildings the prefilter rejects
+def rejected (rules):
+    return (rules == ppt.AREA) | (rules == ppt.MIN_RECTANGLE)
+
+# the adaptive sweep, refined for the buildings the prefilter doesn't reject (see batch_fit)
+def adaptive_fit (lot, rules):
+    dims = np.array(ppt.DIMENSIONS)
+    return ppt.rectangles_fit(ppt.rot_rectangles(lot, refine_dims=dims[~rejected(rules)]), dims)
+
+@pytest.mark.parametrize('adaptive', [False, True])
+@pytest.mark.parametrize('lot_type', LOT_TYPES)
+def test_prefiltered_fit (lot_type, adaptive):
+    rng = np.random.default_rng(3)
+    rules = set()
+    for i in range(40):
+        lot = lot_type(rng)
+        fit, lot_rules = ppt.prefiltered_fit(lot, ppt.DIMENSIONS, adaptive)
+        expected = adaptive_fit(lot, lot_rules) if adaptive else ppt.rot_fit(lot, ppt.DIMENSIONS)
+        np.testing.assert_array_equal(fit, expected, err_msg=f'lot {i} ({lot_rules})')
+        rules.update(lot_rules)
+
+    # the prefilter decides some of them
+    assert rules - {ppt.UNRESOLVED}
+
+@pytest.mark.parametrize('lot_type', LOT_TYPES)
+def test_prefilter_rejects (lot_type):
+    # a rejected building doesn't fit at any rotation the adaptive sweep could try, so refining for it can't help
+    rng = np.random.default_rng(6)
+    lots = np.array([lot_type(rng) for i in range(40)], dtype=object)
+    fit, rules = ppt.prefilter_batch(lots, ppt.DIMENSIONS, adaptive=True)
+    for i, lot in enumerate(lots):
+        swept = ppt.rectangles_fit(ppt.rot_rectangles(lot, ppt.adaptive_rotations()), ppt.DIMENSIONS)
+        assert not swept[rejected(rules[i])].any(), f'lot {i} ({rules[i]})'
+        # the same rules one geometry at a time
+        np.testing.assert_array_equal(ppt.prefilter(lot, ppt.DIMENSIONS, adaptive=True)[1], rules[i])
+
+def test_porous_lot_area ():
+    # buildings fit on porous lots with less area than the building, so those can't be rejected on area alone
+    rng = np.random.default_rng(4)
+    lots = [ppt.random_porous_lot(rng) for i in range(10)]
+    width, height = ppt.DIMENSIONS[0]
+    assert any(lot.area < (width - 1) * (height - 1) and ppt.rot_fit(lot, [(width, height)])[0] for lot in lots)
+
+def batch_lots ():
+    rng = np.random.default_rng(5)
+    # with lots too small and too narrow for any building
+    return np.array([*(ppt.random_parcel(rng) for i in range(20)), None, shapely.Polygon(),
+        *(ppt.random_lot(rng) for i in range(20)), shapely.box(0, 0, 8, 8), shapely.box(0, 0, 100, 5)], dtype=object)
+
+def test_batch_transport ():
+    lots = batch_lots()
+    gids = np.arange(len(lots))
+    apns = np.array([f'{gid:010d}' for gid in gids], dtype=object)
+
+    decoded_gids, decoded_apns, decoded = ppt.decode_batch(*pickle.loads(pickle.dumps(ppt.encode_batch(gids, apns, lots))))
+    np.testing.assert_array_equal(decoded_gids, gids)
+    np.testing.assert_array_equal(decoded_apns, apns)
+    assert all((a is None and b is None) or a.equals_exact(b, 0) for a, b in zip(lots, decoded))
+
+@pytest.mark.parametrize('adaptive', [False, True])
+@pytest.mark.parametrize('index', [True, False])
+def test_batch_fit (index, adaptive):
+    lots = batch_lots()
+    fit, rules, (rect_pos, rotation, width, height) = ppt.batch_fit(lots, ppt.DIMENSIONS, adaptive, index)
+    # fits are sent back packed to bits
+    fit = np.unpackbits(np.packbits(fit), count=fit.size).reshape(fit.shape).astype('bool')
+    dims = np.array(ppt.DIMENSIONS)
+
+    for i, lot in enumerate(lots):
+        expected = adaptive_fit(lot, rules[i]) if adaptive else ppt.rot_fit(lot, ppt.DIMENSIONS)
+        np.testing.assert_array_equal(fit[i], expected, err_msg=f'lot {i}')
+        if index:
+            # parcels where every building is rejected are not swept
+            refine_dims = dims[~rejected(rules[i])] if adaptive else None
+            expected = [] if rejected(rules[i]).all() else \
+                [(rot, w, h) for rot, frontier in ppt.rot_rectangles(lot, refine_dims=refine_dims) for w, h in frontier]
+            assert expected == list(zip(rotation[rect_pos == i], width[rect_pos == i], height[rect_pos == i]))
+        else:
+            assert len(rect_pos) == 0
+
+    # the prefilter rejects some lots outright
+    assert rejected(rules).all(axis=1).any()